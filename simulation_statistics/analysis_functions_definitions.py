@@ -1,5 +1,7 @@
 import numpy as np
 
+from synaptogenesis.geometry import distance
+
 
 def pol2cart(theta, rho):
     x = rho * np.cos(theta)
@@ -7,50 +9,54 @@ def pol2cart(theta, rho):
     return x, y
 
 
+# Sampling tables, which only depend on the size of the matrix sampled, are
+# computed once per size
+_radial_sample_tables = {}
+_odc_masks = {}
+
+
+def radial_sample_table(insize):
+    '''
+    Flat indices of the four neighbours of every (angle, distance) sample
+    point of an insize x insize matrix, and their interpolation weights.
+    '''
+    if insize not in _radial_sample_tables:
+        centre = int(insize / 2. + .5 - 1)
+        sampleradius = np.floor(insize / 2.)
+        angles = np.linspace(0, 2 * np.pi, 100)
+        dists = np.arange(0, sampleradius)
+        tempx, tempy = pol2cart(angles[:, None], dists[None, :])
+        xfloor = np.floor(tempx).astype(int) + centre
+        xceil = np.ceil(tempx).astype(int) + centre
+        yfloor = np.floor(tempy).astype(int) + centre
+        yceil = np.ceil(tempy).astype(int) + centre
+        indices = np.array([yfloor * insize + xfloor,
+                            yfloor * insize + xceil,
+                            yceil * insize + xfloor,
+                            yceil * insize + xceil])
+        x_weight = np.mod(tempx, 1)
+        y_weight = np.mod(tempy, 1)
+        _radial_sample_tables[insize] = (indices, x_weight, 1 - x_weight,
+                                         y_weight, 1 - y_weight)
+    return _radial_sample_tables[insize]
+
+
 def radial_sample(in_matrix, samplenum):
-    _, insize = in_matrix.shape
-    centre = int(insize / 2. + .5 - 1)
-    sampleradius = np.floor(insize / 2.)
-    out = np.zeros(int(sampleradius))
-    angles = np.linspace(0, 2 * np.pi, 100)
-    dists = np.arange(0, sampleradius)
-    for angle in angles:
-        for dist in dists:
-            tempx, tempy = pol2cart(angle, dist)
-            yceil = int(np.ceil(tempy))
-            yfloor = int(np.floor(tempy))
-            xceil = int(np.ceil(tempx))
-            xfloor = int(np.floor(tempx))
-            if yceil == yfloor:
-                if xceil == xfloor:
-                    sample = in_matrix[
-                        int(yceil + centre), int(xceil + centre)]
-                else:
-                    sample = in_matrix[yceil + centre, xfloor + centre] * \
-                             np.mod(tempx, 1) + in_matrix[
-                                                    yceil + centre, xceil + centre] * \
-                                                (1 - np.mod(tempx, 1))
-            else:
-                if xceil == xfloor:
-                    sample = in_matrix[yfloor + centre, xceil + centre] * \
-                             np.mod(tempy, 1) + in_matrix[
-                                                    yceil + centre, xceil + centre] * \
-                                                (1 - np.mod(tempy, 1))
-                else:
-                    yfloorsample = in_matrix[
-                                       yfloor + centre, xfloor + centre] * \
-                                   np.mod(tempx, 1) + in_matrix[
-                                                          yfloor + centre, xceil + centre] * \
-                                                      (1 - np.mod(tempx, 1))
-                    yceilsample = in_matrix[
-                                      yceil + centre, xfloor + centre] * np.mod(
-                        tempx, 1) + in_matrix[
-                                        yceil + centre, xceil + centre] * (
-                                        1 - np.mod(tempx, 1))
-                    sample = yfloorsample * np.mod(tempy, 1) + yceilsample * (
-                        1 - np.mod(tempy, 1))
-            out[int(dist)] = out[int(dist)] + sample
-    return out / float(samplenum)
+    '''
+    Sum over 100 angles of in_matrix interpolated at every integer distance
+    from its centre, divided by samplenum.
+    '''
+    in_matrix = np.asarray(in_matrix)
+    indices, x_floor_weight, x_ceil_weight, y_floor_weight, y_ceil_weight = \
+        radial_sample_table(in_matrix.shape[1])
+    floor_floor, floor_ceil, ceil_floor, ceil_ceil = \
+        in_matrix.ravel()[indices]
+    # Exact when a point falls on a row or column: its other weight is 0
+    samples = (floor_floor * x_floor_weight +
+               floor_ceil * x_ceil_weight) * y_floor_weight + \
+              (ceil_floor * x_floor_weight +
+               ceil_ceil * x_ceil_weight) * y_ceil_weight
+    return np.sum(samples, axis=0) / float(samplenum)
 
 
 # Function definitions
@@ -74,230 +80,216 @@ def conn_matrix_to_fan_in(conn_matrix, mode):
     return fan_in
 
 
-def centre_weights(in_star_all, n1d):
-    in_star_all = np.copy(in_star_all)
+def _halve_edges(windows):
+    # A window one wider than the field holds its first row and column twice
+    edge = windows.shape[-1] - 1
+    windows[..., 0, :] /= 2.
+    windows[..., edge, :] /= 2.
+    windows[..., :, 0] /= 2.
+    windows[..., :, edge] /= 2.
+    return windows
+
+
+def _window_std_devs(windows, positions):
+    # Spread of the windows along x (over columns) and y (over rows)
+    centred_x = np.sum(windows, axis=-2)
+    centred_y = np.sum(windows, axis=-1)
+    return (np.sqrt(np.sum(centred_x * (positions ** 2), axis=-1) /
+                    np.sum(centred_x, axis=-1)),
+            np.sqrt(np.sum(centred_y * (positions ** 2), axis=-1) /
+                    np.sum(centred_y, axis=-1)))
+
+
+def _shift(windows, fraction, axis):
+    # Move windows by a fraction of a pixel along axis, towards the start for
+    # negative fractions
+    n1d = windows.shape[-1] - 1
+    second_to_first_indices = np.concatenate((np.arange(1, n1d + 1), [0]))
+    last_to_first_indices = np.concatenate(([n1d], np.arange(0, n1d)))
+    fraction = fraction.reshape(-1, 1, 1)
+    return np.take(windows, second_to_first_indices, axis=axis) * \
+           np.maximum(0., -fraction) + \
+           windows * (1. - np.abs(fraction)) + \
+           np.take(windows, last_to_first_indices, axis=axis) * \
+           np.maximum(0., fraction)
+
+
+def centre_weights(in_star_all, n1d, chunk_size=None):
+    '''
+    Centre the receptive field of every target neuron, found in the n1d x n1d
+    blocks of in_star_all, first to the window position and then to the
+    tenth of a pixel that minimises its spread. All neurons are processed
+    together, chunk_size at a time, with the sums taken in the same order as
+    the one neuron at a time version so the results are identical.
+    '''
     half_range = n1d // 2
-    mean_projection = np.zeros((n1d + 1, n1d + 1))
-    mean_centred_projection = np.zeros((n1d + 1, n1d + 1))
+    width = 2 * half_range + 1
     positions = np.arange(-half_range, half_range + 1)
+    fine_positions = np.linspace(-.5, .5, 11)
+    if chunk_size is None:
+        chunk_size = max(1, 2 ** 22 // (n1d * width ** 2))
+
+    # Receptive field of neuron y * n1d + x, and the rows (or columns) of a
+    # field seen through a window centred on each position, wrapping around
+    # like np.tile(in_star, [3, 3])
+    in_stars = np.ascontiguousarray(
+        np.asarray(in_star_all, dtype=float).reshape(
+            n1d, n1d, n1d, n1d).transpose(0, 2, 1, 3)).reshape(
+        n1d ** 2, n1d, n1d)
+    wrapped = np.mod(
+        np.arange(n1d)[:, None] - half_range + np.arange(width), n1d)
+    ys, xs = np.divmod(np.arange(n1d ** 2), n1d)
+
+    active = np.flatnonzero(np.sum(in_stars.reshape(n1d ** 2, -1),
+                                   axis=1) > 0)
+    pos_x = np.zeros(n1d ** 2, dtype=int)
+    pos_y = np.zeros(n1d ** 2, dtype=int)
+    pos_x_fine = np.zeros(n1d ** 2)
+    pos_y_fine = np.zeros(n1d ** 2)
+    std_dev = np.zeros(n1d ** 2)
+    mean_projection = np.zeros((width, width))
+    mean_centred_projection = np.zeros((width, width))
+
+    for start in range(0, active.size, chunk_size):
+        chunk = active[start:start + chunk_size]
+        fields = in_stars[chunk]
+        rows = np.arange(chunk.size)[:, None, None]
+
+        # Window centred on the neuron itself, for the mean projection
+        ideal_centred = _halve_edges(
+            fields[rows, wrapped[ys[chunk]][:, :, None],
+                   wrapped[xs[chunk]][:, None, :]])
+        mean_projection = np.sum(
+            np.concatenate((mean_projection[None], ideal_centred)), axis=0)
+
+        # Coarse centre of mass: the diagonal window position with the
+        # smallest spread, separately along x and y
+        std_devs_xs, std_devs_ys = _window_std_devs(
+            _halve_edges(fields[:, wrapped[:, :, None],
+                                wrapped[:, None, :]]),
+            positions)
+        chunk_pos_x = np.argmin(std_devs_xs, axis=1)
+        chunk_pos_y = np.argmin(std_devs_ys, axis=1)
+        coarse = fields[rows, wrapped[chunk_pos_y][:, :, None],
+                        wrapped[chunk_pos_x][:, None, :]]
+
+        # Fine centre of mass: weight the window edges for shifts of a
+        # tenth of a pixel
+        fine = np.repeat(coarse[:, None], fine_positions.size, axis=1)
+        fine[..., 0, :] *= (.5 - fine_positions)[:, None]
+        fine[..., width - 1, :] *= (.5 + fine_positions)[:, None]
+        fine[..., :, 0] *= (.5 - fine_positions)[:, None]
+        fine[..., :, width - 1] *= (.5 + fine_positions)[:, None]
+        std_devs_xs_fine, std_devs_ys_fine = _window_std_devs(
+            fine, positions - fine_positions[:, None])
+        chunk_pos_x_fine = (np.argmin(std_devs_xs_fine, axis=1) - 5) / 10.
+        chunk_pos_y_fine = (np.argmin(std_devs_ys_fine, axis=1) - 5) / 10.
+
+        # Finely centred receptive fields, for the mean centred projection
+        centred_fine = _shift(
+            _shift(_halve_edges(coarse), chunk_pos_x_fine, axis=2),
+            chunk_pos_y_fine, axis=1)
+        mean_centred_projection = np.sum(
+            np.concatenate((mean_centred_projection[None], centred_fine)),
+            axis=0)
+
+        pos_x[chunk] = chunk_pos_x
+        pos_y[chunk] = chunk_pos_y
+        pos_x_fine[chunk] = chunk_pos_x_fine
+        pos_y_fine[chunk] = chunk_pos_y_fine
+        std_dev[chunk] = (np.min(std_devs_xs_fine, axis=1) +
+                          np.min(std_devs_ys_fine, axis=1)) / 2.
+
+    mean_x = np.zeros(n1d ** 2)
+    mean_y = np.zeros(n1d ** 2)
+    mean_x[active] = pos_x[active] + pos_x_fine[active] - xs[active]
+    mean_y[active] = pos_y[active] + pos_y_fine[active] - ys[active]
+    for mean in (mean_x, mean_y):
+        mean[mean > half_range] -= n1d
+        mean[mean < -half_range] += n1d
+    mean_dist = np.sqrt(mean_x ** 2 + mean_y ** 2)
+    moved = mean_dist != 0
+
     means_and_std_devs = np.zeros((n1d ** 2, 8))
+    means_and_std_devs[:, 0] = xs
+    means_and_std_devs[:, 1] = ys
+    means_and_std_devs[:, 2] = mean_x
+    means_and_std_devs[:, 3] = mean_y
+    means_and_std_devs[:, 4] = mean_dist
+    means_and_std_devs[:, 5] = std_dev
+    means_and_std_devs[moved, 6] = mean_x[moved] / mean_dist[moved]
+    means_and_std_devs[moved, 7] = mean_y[moved] / mean_dist[moved]
+
+    # For mapping plots: the neurons in boustrophedon order along rows, then
+    # along columns
     means_for_plot = np.ones((n1d ** 2 * 2 - 1, 2)) * np.nan
-    std_devs_xs = np.zeros(n1d)
-    std_devs_ys = np.zeros(n1d)
-    std_devs_xs_fine = np.zeros(11)
-    std_devs_ys_fine = np.zeros(11)
-
-    for y in range(n1d):
-        for x in range(n1d):
-            in_star = np.copy(
-                in_star_all[y * n1d:(y + 1) * n1d, x * n1d:(x + 1) * n1d])
-            in_star_extended = np.tile(in_star, [3, 3])
-            if np.sum(in_star) > 0:
-                # Add to the mean projection
-                ideal_centred = np.copy(in_star_extended[
-                                        n1d + y - half_range: n1d + y + half_range + 1,
-                                        n1d + x - half_range:n1d + x + half_range + 1])
-                ideal_centred[0, :] = ideal_centred[0, :] / 2.
-                ideal_centred[n1d, :] = ideal_centred[n1d, :] / 2.
-                ideal_centred[:, 0] = ideal_centred[:, 0] / 2.
-                ideal_centred[:, n1d] = ideal_centred[:, n1d] / 2.
-
-                mean_projection += ideal_centred
-
-                #  ^^ So far so good ^^
-                # Find the coarse centre of mass
-                for pos in range(n1d):
-                    temp_centred = np.copy(in_star_extended[
-                                           n1d + pos - half_range: n1d + pos + half_range + 1,
-                                           n1d + pos - half_range:n1d + pos + half_range + 1])
-                    # correct the edges of centred
-                    temp_centred[0, :] = temp_centred[0, :] / 2.
-                    temp_centred[n1d, :] = temp_centred[n1d, :] / 2.
-                    temp_centred[:, 0] = temp_centred[:, 0] / 2.
-                    temp_centred[:, n1d] = temp_centred[:, n1d] / 2.
-                    # calculate the StdDev
-                    centred_x = np.sum(temp_centred, axis=0)
-                    centred_y = np.sum(temp_centred, axis=1)
-                    std_devs_xs[pos] = np.sqrt(
-                        np.sum(centred_x * (positions ** 2)) / np.sum(
-                            centred_x));
-                    std_devs_ys[pos] = np.sqrt(
-                        np.sum(centred_y * (positions ** 2)) / np.sum(
-                            centred_y));
-
-                std_dev_x = np.min(std_devs_xs)
-                pos_x = np.argmin(std_devs_xs)
-                std_dev_y = np.min(std_devs_ys)
-                pos_y = np.argmin(std_devs_ys)
-
-                #                 print pos_x, pos_y
-                #                 print std_dev_x, std_dev_y
-
-
-
-                # reconstruct the coarsely centred receptive field
-                centred_coarse = np.copy(in_star_extended[
-                                         n1d + pos_y - half_range:n1d + pos_y + half_range + 1,
-                                         n1d + pos_x - half_range:n1d + pos_x + half_range + 1])
-                centred_coarse[0, :] = centred_coarse[0, :] / 2.
-                centred_coarse[n1d, :] = centred_coarse[n1d, :] / 2.
-                centred_coarse[:, 0] = centred_coarse[:, 0] / 2.
-                centred_coarse[:, n1d] = centred_coarse[:, n1d] / 2.
-
-                for pos_fine in np.linspace(-.5, .5, 11):
-                    assert std_devs_xs[
-                               pos_x] == std_dev_x, "{0} != {1}".format(
-                        std_devs_xs[pos_x], std_dev_x)
-                    assert std_devs_ys[
-                               pos_y] == std_dev_y, "{0} != {1}".format(
-                        std_devs_ys[pos_y], std_dev_y)
-
-                    temp_centred_fine = np.copy(in_star_extended[
-                                                n1d + pos_y - half_range: n1d + pos_y + half_range + 1,
-                                                n1d + pos_x - half_range:n1d + pos_x + half_range + 1])
-                    # correct the edges of centred
-                    temp_centred_fine[0, :] = temp_centred_fine[0, :] * (
-                        .5 - pos_fine)
-                    temp_centred_fine[n1d, :] = temp_centred_fine[n1d, :] * (
-                        .5 + pos_fine)
-                    temp_centred_fine[:, 0] = temp_centred_fine[:, 0] * (
-                        .5 - pos_fine)
-                    temp_centred_fine[:, n1d] = temp_centred_fine[:, n1d] * (
-                        .5 + pos_fine)
-
-                    # calculate the StdDev
-                    centred_x = np.sum(temp_centred_fine, axis=0)
-                    centred_y = np.sum(temp_centred_fine, axis=1)
-                    positions_fine = np.arange(-half_range,
-                                               half_range + 1) - pos_fine
-                    positions_fine = positions_fine.flatten()
-                    std_devs_xs_fine[
-                        int(np.round(pos_fine * 10) + 5)] = np.sqrt(
-                        np.sum(centred_x * (positions_fine ** 2)) / np.sum(
-                            centred_x))
-                    std_devs_ys_fine[
-                        int(np.round(pos_fine * 10) + 5)] = np.sqrt(
-                        np.sum(centred_y * (positions_fine ** 2)) / np.sum(
-                            centred_y))
-
-                # assert np.isclose(std_dev_x, std_devs_xs_fine[5]), "{0} != {1}".format(
-                #     std_dev_x, std_devs_xs_fine[5])
-                # assert np.isclose(std_dev_y, std_devs_ys_fine[5]), "{0} != {1}".format(
-                #     std_dev_y, std_devs_ys_fine[5])
-                std_dev_x = np.min(std_devs_xs_fine)
-                pos_x_fine = np.argmin(std_devs_xs_fine)
-                std_dev_y = np.min(std_devs_ys_fine)
-                pos_y_fine = np.argmin(std_devs_ys_fine)
-                pos_x_fine = (pos_x_fine - 5) / 10.
-                pos_y_fine = (pos_y_fine - 5) / 10.
-
-                # reconstruct the finely centred receptive field
-                # and add to the mean centred projection
-                second_to_first_indices = np.concatenate(
-                    (np.arange(1, n1d + 1), [0]))
-                last_to_first_indices = np.concatenate(
-                    ([n1d], np.arange(0, n1d)))  # checked
-
-                centred_left = centred_coarse[:, second_to_first_indices]
-                centred_right = centred_coarse[:, last_to_first_indices]
-                centred_fine_x = centred_left * np.max([0., -pos_x_fine]) + \
-                                 centred_coarse * (1. - np.abs(pos_x_fine)) + \
-                                 centred_right * np.max([0., pos_x_fine])
-
-                centred_up = centred_fine_x[second_to_first_indices, :]
-                centred_down = centred_fine_x[last_to_first_indices, :]
-                centred_fine = centred_up * np.max([0., -pos_y_fine]) + \
-                               centred_fine_x * (1. - np.abs(pos_y_fine)) + \
-                               centred_down * np.max([0., pos_y_fine])
-
-                mean_centred_projection += centred_fine
-
-                std_dev = np.mean([std_dev_x, std_dev_y])
-                mean_x = pos_x + pos_x_fine - x
-                mean_y = pos_y + pos_y_fine - y
-                if mean_x > half_range:
-                    mean_x = mean_x - n1d
-                if mean_x < -half_range:
-                    mean_x = mean_x + n1d
-                if mean_y > half_range:
-                    mean_y = mean_y - n1d
-                if mean_y < -half_range:
-                    mean_y = mean_y + n1d
-                mean_dist = np.sqrt(mean_x ** 2 + mean_y ** 2)
-            else:
-                mean_x = 0
-                mean_y = 0
-                mean_dist = 0
-                std_dev = 0
-            # For quiver plots
-            if mean_dist == 0:
-                means_and_std_devs[y * n1d + x, :] = np.asarray(
-                    [x, y, mean_x, mean_y, mean_dist, std_dev, 0, 0])
-            else:
-                means_and_std_devs[y * n1d + x, :] = np.asarray(
-                    [x, y, mean_x, mean_y, mean_dist, std_dev,
-                     mean_x / mean_dist, mean_y / mean_dist])
-                # For mapping plots
-                Y = y + 1
-                X = x + 1
-
-                means_for_plot[(Y - 1) * n1d + X * np.remainder(Y, 2) +
-                               (n1d + 1 - X) * np.remainder(Y - 1, 2) - 1,
-                :] = [X + mean_x, Y + mean_y]
-                means_for_plot[(X - 1) * n1d + Y * np.remainder(X - 1, 2) + (
-                                                                            n1d + 1 - Y) * np.remainder(
-                    X, 2) + n1d ** 2 - 1 - 1, :] = [X + mean_x, Y + mean_y]
-                #     return (mean_projection/(n1d**2), std_dev)
+    X = xs[moved] + 1
+    Y = ys[moved] + 1
+    plot_points = np.column_stack((X + mean_x[moved], Y + mean_y[moved]))
+    means_for_plot[(Y - 1) * n1d + X * np.remainder(Y, 2) +
+                   (n1d + 1 - X) * np.remainder(Y - 1, 2) - 1] = plot_points
+    means_for_plot[(X - 1) * n1d + Y * np.remainder(X - 1, 2) +
+                   (n1d + 1 - Y) * np.remainder(X, 2) + n1d ** 2 - 2] = \
+        plot_points
+
     mean_projection = mean_projection / (n1d ** 2.)
     mean_centred_projection /= (n1d ** 2.)
     return (mean_projection, means_and_std_devs, means_for_plot,
             mean_centred_projection)
 
 
-def fan_in(conn, weight, mode, area):
-    conn = np.copy(conn).astype(np.int32)
+def grid_shape(grid, N_layer):
+    '''
+    (rows, columns) of the target layer; a square grid when not given.
+    '''
+    if grid is not None:
+        return int(grid[0]), int(grid[1])
+    n = int(np.round(np.sqrt(N_layer)))
+    assert n ** 2 == N_layer, "{0} neurons do not form a square grid".format(
+        N_layer)
+    return n, n
+
+
+def fan_in(conn, weight, mode, area, grid=None):
+    '''
+    Fan-in of every target neuron tiled into a (rows ** 2, columns ** 2)
+    image: the synapses from pre to post land at (post_x * rows + pre_x,
+    post_y * columns + pre_y), counted in 'conn' mode and summed by weight
+    otherwise. conn and weight are (slot, post) arrays from list_to_post_pre.
+    '''
+    conn = np.asarray(conn).astype(np.int32)
+    rows, columns = grid_shape(grid, conn.shape[1])
+    N_layer = rows * columns
+    valid = conn >= 0
     if 'rec' in area:
-        conn[conn <= 255] = -1
+        valid &= conn > N_layer - 1
     if 'ff' in area:
-        conn[conn > 255] = -1
-    output = np.zeros((256, 256))
-
-    for syn in range(conn.shape[0]):
-        for post_x in range(16):
-            for post_y in range(16):
-                pre_loc = int(conn[syn, post_x * 16 + post_y])
-                if pre_loc >= 0:
-                    pre_loc = np.mod(pre_loc, 256)
-                    pre_x = int(np.floor(pre_loc / 16.))
-                    pre_y = np.mod(pre_loc, 16)
-                    #                     print pre_x, pre_y, post_x, post_y
-                    #                     break
-                    if 'conn' in mode:
-                        output[post_x * 16 + pre_x, post_y * 16 + pre_y] += 1
-                    else:
-                        output[post_x * 16 + pre_x, post_y * 16 + pre_y] += \
-                            weight[syn, post_x * 16 + post_y]
-    return output
-
-
-def distance(x0, x1, grid=np.asarray([16, 16]), type='euclidian'):
-    x0 = np.asarray(x0)
-    x1 = np.asarray(x1)
-    delta = np.abs(x0 - x1)
-    delta = np.where(delta > grid * .5, delta - grid, delta)
-
-    if type == 'manhattan':
-        return np.abs(delta).sum(axis=-1)
-    return np.sqrt((delta ** 2).sum(axis=-1))
+        valid &= conn <= N_layer - 1
+    slots, post = np.nonzero(valid)
+    pre_x, pre_y = np.divmod(np.mod(conn[slots, post], N_layer), columns)
+    post_x, post_y = np.divmod(post, columns)
+    if 'conn' in mode:
+        values = None
+    else:
+        values = weight[slots, post]
+    # bincount adds the synapses of each pixel in slot order, like the
+    # original loop over slots
+    image = (post_x * rows + pre_x) * columns ** 2 + \
+            post_y * columns + pre_y
+    return np.bincount(image, weights=values,
+                       minlength=N_layer ** 2).astype(float).reshape(
+        rows ** 2, columns ** 2)
 
 
 def weight_shuffle(conn, weights, area):
+    # Feedforward sources are [0, N_layer), lateral ones are offset by N_layer
+    N_layer = conn.shape[1]
     weights_copy = weights.copy()
     for post_id in range(weights_copy.shape[1]):
         pre_ids = conn[:, post_id]
         pre_weights = weights_copy[:, post_id]
         within_row_filter = np.argwhere(
-            np.logical_and(pre_ids >= 0, pre_ids <= 255))
+            np.logical_and(pre_ids >= 0, pre_ids < N_layer))
         permutation = np.random.permutation(within_row_filter)
         for index in range(within_row_filter.size):
             weights_copy[permutation[index], post_id] = weights[
@@ -306,50 +298,93 @@ def weight_shuffle(conn, weights, area):
     return weights_copy
 
 
-def list_to_post_pre(ff_list, lat_list, s_max, N_layer):
+def post_pre_csr(ff_list, lat_list, N_layer):
+    '''
+    Incoming synapses of every target neuron in compressed sparse row form,
+    (offsets, pre_ids, weights): target t receives from
+    pre_ids[offsets[t]:offsets[t + 1]], feedforward sources first and then
+    lateral ones offset by N_layer, each in list order.
+    '''
+    ff_list = np.asarray(ff_list, dtype=float).reshape(-1, 4)
+    lat_list = np.asarray(lat_list if lat_list is not None else [],
+                          dtype=float).reshape(-1, 4)
+    targets = np.concatenate((ff_list[:, 1], lat_list[:, 1])).astype(int)
+    pre_ids = np.concatenate((ff_list[:, 0], lat_list[:, 0] + N_layer))
+    weights = np.concatenate((ff_list[:, 2], lat_list[:, 2]))
+    in_layer = (targets >= 0) & (targets < N_layer)
+    targets = targets[in_layer]
+    # A stable sort keeps feedforward before lateral and the list order
+    order = np.argsort(targets, kind='mergesort')
+    offsets = np.concatenate(
+        ([0], np.cumsum(np.bincount(targets, minlength=N_layer))))
+    return offsets, pre_ids[in_layer][order], weights[in_layer][order]
+
+
+def csr_to_post_pre(csr, s_max):
+    '''
+    (2 * s_max, N_layer) ConnPostToPre tables of presynaptic ids (-1 for an
+    empty slot) and weights, keeping the first 2 * s_max synapses of every
+    target.
+    '''
+    offsets, pre_ids, weights = csr
+    N_layer = offsets.size - 1
     conn = np.ones((s_max * 2, N_layer)) * -1
     weight = np.zeros((s_max * 2, N_layer))
-
-    for target in range(N_layer):
-        # source ids
-        ff_pre_ids = ff_list[ff_list[:, 1] == target][:, 0]
-        if lat_list.size > 0:
-            lat_pre_ids = lat_list[lat_list[:, 1] == target][:, 0] + N_layer
-            lat_pre_weights = lat_list[lat_list[:, 1] == target][:, 2]
-        else:
-            lat_pre_ids = np.asarray([])
-            lat_pre_weights = np.asarray([])
-        conn[:ff_pre_ids.size + lat_pre_ids.size, target] \
-            = np.concatenate((ff_pre_ids, lat_pre_ids))[:s_max * 2]
-        # weights
-        ff_pre_weights = ff_list[ff_list[:, 1] == target][:, 2]
-        weight[:ff_pre_weights.size + lat_pre_weights.size, target] \
-            = np.concatenate((ff_pre_weights, lat_pre_weights))[:s_max * 2]
+    targets = np.repeat(np.arange(N_layer), np.diff(offsets))
+    slots = np.arange(targets.size) - offsets[targets]
+    kept = slots < s_max * 2
+    conn[slots[kept], targets[kept]] = pre_ids[kept]
+    weight[slots[kept], targets[kept]] = weights[kept]
     return conn, weight
 
 
+def csr_synapse_counts(csr):
+    '''
+    Number of feedforward and of lateral synapses onto every target.
+    '''
+    offsets, pre_ids, _ = csr
+    N_layer = offsets.size - 1
+    targets = np.repeat(np.arange(N_layer), np.diff(offsets))
+    ff_counts = np.bincount(targets[pre_ids < N_layer], minlength=N_layer)
+    return ff_counts, np.diff(offsets) - ff_counts
+
+
+def list_to_post_pre(ff_list, lat_list, s_max, N_layer):
+    return csr_to_post_pre(post_pre_csr(ff_list, lat_list, N_layer), s_max)
+
+
+def odc_mask(n1d):
+    '''
+    Checkerboard of the presynaptic positions of one eye.
+    '''
+    if n1d not in _odc_masks:
+        pre_y, pre_x = np.indices((n1d, n1d))
+        _odc_masks[n1d] = np.mod(pre_x + pre_y, 2).astype(float)
+    return _odc_masks[n1d]
+
+
 def odc(fan_in_mat, mode=None):
+    '''
+    Ocular dominance of every target neuron: the share of its fan-in coming
+    from the checkerboard positions of odc_mask, .5 if it has no fan-in. With
+    a NORMALISE mode the mean non-zero entry on the mask over the mean
+    non-zero entry overall, squashed into (-1, 1).
+    '''
     n1d = int(np.sqrt(fan_in_mat.shape[0]))
-    odc_mask = np.zeros((n1d, n1d))
-    for pre_y in range(n1d):
-        for pre_x in range(n1d):
-            odc_mask[pre_y, pre_x] = np.mod(pre_x + pre_y, 2)
-    output = np.zeros((n1d, n1d))
-
-    for post_y in range(n1d):
-        for post_x in range(n1d):
-            fan_in_temp = fan_in_mat[post_y * n1d:(post_y + 1) * n1d,
-                        post_x * n1d:(post_x + 1) * n1d]
-            if mode and 'NORMALISE' in mode.upper():
-                temp = np.sum(np.sum(fan_in_temp * odc_mask)) / np.sum(
-                    np.sum(np.logical(fan_in_temp * odc_mask))) / np.sum(
-                    np.sum(fan_in_temp)) * np.sum(
-                    np.sum(np.logical(fan_in_temp)))
-                temp[np.where(np.isnan(temp))] = 1.
-                output[post_y, post_x] = (1. / (1 + np.exp(-temp)) - 0.5) * 2
-            else:
-                output[post_y, post_x] = np.sum(
-                    np.sum(fan_in_temp * odc_mask)) / np.sum(np.sum(fan_in_temp))
-
-    output[np.where(np.isnan(output))] = .5
-    return output
\ No newline at end of file
+    # Fan-in of every target neuron, (post_y, post_x, pre_y * n1d + pre_x)
+    fan_ins = np.ascontiguousarray(
+        np.asarray(fan_in_mat).reshape(n1d, n1d, n1d, n1d).transpose(
+            0, 2, 1, 3)).reshape(n1d, n1d, n1d ** 2)
+    masked = fan_ins * odc_mask(n1d).ravel()
+    masked_total = np.sum(masked, axis=2)
+    total = np.sum(fan_ins, axis=2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if mode and 'NORMALISE' in mode.upper():
+            temp = masked_total / np.count_nonzero(masked, axis=2) / \
+                   total * np.count_nonzero(fan_ins, axis=2)
+            temp[np.isnan(temp)] = 1.
+            output = (1. / (1 + np.exp(-temp)) - 0.5) * 2
+        else:
+            output = masked_total / total
+    output[np.isnan(output)] = .5
+    return output
@@ -13,4 +13,11 @@ parser.add_argument('--plot', help="display plots",
 parser.add_argument('--snapshots', help="run snapshot analysis",
                     action="store_true")
 
+parser.add_argument('--processes', type=int, dest='processes',
+                    help="number of archives analysed in parallel in batch "
+                         "mode (default: one per core)")
+
+parser.add_argument('--seed', type=int, dest='seed',
+                    help="seed for the random shuffles of the analysis")
+
 args = parser.parse_args()
@@ -0,0 +1,164 @@
+from __future__ import division
+
+import argparse
+
+import numpy as np
+
+# +-------------------------------------------------------------------+
+# | MNIST classification readout                                      |
+# +-------------------------------------------------------------------+
+
+# In testing mode every target column was trained on one digit (column i on
+# digit i) and the input switches to a new sample every t_stim ms, starting at
+# T_START. A presentation window is classified as the column that fired the
+# most spikes in it; windows in which no column fired have no prediction.
+
+T_START = 100  # ms, start of the Poisson sources in the MNIST scripts
+N_CLASSES = 10
+NO_PREDICTION = -1
+
+
+def as_spike_array(spikes):
+    '''
+    getSpikes output, possibly an empty list, as an (N, 2) array of
+    (neuron id, time) rows.
+    '''
+    return np.asarray(spikes, dtype=float).reshape(-1, 2)
+
+
+def window_counts(column_spikes, t_stim, no_windows, t_start=T_START):
+    '''
+    Spike count of every column in every presentation window, as a
+    (no_windows, no_columns) array, from a single bincount over all columns.
+    '''
+    no_columns = len(column_spikes)
+    windows, columns = [], []
+    for column, spikes in enumerate(column_spikes):
+        times = as_spike_array(spikes)[:, 1]
+        window = np.floor((times - t_start) / t_stim).astype(np.int64)
+        window = window[(window >= 0) & (window < no_windows)]
+        windows.append(window)
+        columns.append(np.full(window.size, column, dtype=np.int64))
+    if not windows:
+        return np.zeros((no_windows, 0), dtype=np.int64)
+    bins = np.concatenate(windows) * no_columns + np.concatenate(columns)
+    return np.bincount(bins, minlength=no_windows * no_columns).reshape(
+        no_windows, no_columns)
+
+
+def winner_take_all(counts):
+    '''
+    Column with the most spikes in each window, NO_PREDICTION where no column
+    fired. Ties go to the lowest column.
+    '''
+    predictions = np.argmax(counts, axis=1)
+    predictions[counts.max(axis=1) == 0] = NO_PREDICTION
+    return predictions
+
+
+def confusion_matrix(labels, predictions, no_classes=N_CLASSES):
+    '''
+    (no_classes, no_classes + 1) counts of presented digit against predicted
+    column. The last column counts the windows with no prediction.
+    '''
+    labels = np.asarray(labels, dtype=np.int64)
+    predictions = np.where(predictions == NO_PREDICTION, no_classes,
+                           predictions)
+    return np.bincount(labels * (no_classes + 1) + predictions,
+                       minlength=no_classes * (no_classes + 1)).reshape(
+        no_classes, no_classes + 1)
+
+
+def class_rates(counts, labels, t_stim, no_classes=N_CLASSES,
+                no_neurons=1):
+    '''
+    Mean firing rate (Hz) of every column while each digit is presented, as a
+    (no_classes, no_columns) table. Divide by no_neurons for per-neuron rates.
+    Digits never presented have NaN rates.
+    '''
+    labels = np.asarray(labels, dtype=np.int64)
+    no_columns = counts.shape[1]
+    totals = np.zeros((no_classes, no_columns))
+    np.add.at(totals, labels, counts)
+    presentations = np.bincount(labels, minlength=no_classes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return totals / (presentations[:, None] * t_stim / 1000. *
+                         no_neurons)
+
+
+def column_rates(counts, t_stim, no_neurons=1):
+    '''
+    Mean firing rate (Hz) of every column over the whole test.
+    '''
+    return counts.mean(axis=0) / (t_stim / 1000. * no_neurons)
+
+
+def mnist_readout(post_spikes, labels, t_stim, t_start=T_START,
+                  no_classes=N_CLASSES, no_neurons=1):
+    '''
+    Score the column spikes of a testing run against its label schedule.
+    '''
+    labels = np.asarray(labels, dtype=np.int64)
+    counts = window_counts(post_spikes, t_stim, labels.size, t_start)
+    predictions = winner_take_all(counts)
+    confusion = confusion_matrix(labels, predictions, no_classes)
+    correct = np.trace(confusion[:, :no_classes])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        per_class_accuracy = np.diag(confusion).astype(float) / \
+                             confusion.sum(axis=1)
+    return {'counts': counts,
+            'predictions': predictions,
+            'accuracy': correct / float(max(labels.size, 1)),
+            'per_class_accuracy': per_class_accuracy,
+            'no_prediction': np.count_nonzero(
+                predictions == NO_PREDICTION),
+            'confusion': confusion,
+            'class_rates': class_rates(counts, labels, t_stim, no_classes,
+                                       no_neurons),
+            'column_rates': column_rates(counts, t_stim, no_neurons)}
+
+
+def archive_readout(filename, t_start=T_START, per_neuron=False):
+    '''
+    Readout of a testing archive saved by one of the MNIST scripts.
+    '''
+    data = np.load(filename, allow_pickle=True)
+    try:
+        labels = data['testing_numbers']
+        if labels.shape == ():
+            raise ValueError(
+                "{} holds no testing schedule".format(filename))
+        sim_params = data['sim_params'].ravel()[0]
+        post_spikes = list(data['post_spikes'])
+    finally:
+        data.close()
+    no_neurons = 1
+    if per_neuron:
+        no_neurons = int(np.prod(sim_params['grid']))
+    return mnist_readout(post_spikes, labels, sim_params['t_stim'], t_start,
+                         no_neurons=no_neurons)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Classification accuracy of MNIST testing runs')
+    parser.add_argument('path', help='path of .npz archive', nargs='+')
+    parser.add_argument('--t_start', type=float, default=T_START,
+                        help='time (ms) at which the first digit is shown')
+    parser.add_argument('--per_neuron', action="store_true",
+                        help='report per-neuron rather than column rates')
+    args = parser.parse_args()
+
+    np.set_printoptions(precision=2, suppress=True, linewidth=120)
+    for filename in args.path:
+        results = archive_readout(filename, args.t_start, args.per_neuron)
+        print("=" * 60)
+        print(filename)
+        print("Accuracy {:.2%}, {} windows without a response".format(
+            results['accuracy'], results['no_prediction']))
+        print("Per-class accuracy " + str(results['per_class_accuracy']))
+        print("Confusion (rows: digit, columns: prediction, none)")
+        print(results['confusion'])
+        print("Class rates (Hz, rows: digit, columns: column)")
+        print(results['class_rates'])
+        print("Column rates (Hz) " + str(results['column_rates']))
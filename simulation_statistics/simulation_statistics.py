@@ -1,5 +1,7 @@
 from __future__ import division
 from collections import Iterable
+from multiprocessing import Pool
+import os
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -11,6 +13,7 @@ import scipy
 import scipy.stats as stats
 from glob import glob
 from pprint import pprint as pp
+from synaptogenesis.fileutils import atomic_write
 from synaptogenesis.function_definitions import *
 from analysis_functions_definitions import *
 from argparser import *
@@ -42,7 +45,42 @@ if sensitivity_analysis:
     print "BATCH ANALYSIS!"
     print
 
-for file in paths:
+# One seed per archive, so that its shuffles do not depend on which archives
+# were analysed before it, or by which worker
+np.random.seed(args.seed)
+archive_seeds = [new_seed() for _ in paths]
+
+
+def output_name(name, archive):
+    '''
+    name, suffixed with the analysed archive in batch mode so the outputs of
+    different archives never overwrite each other.
+    '''
+    if not sensitivity_analysis:
+        return name
+    if name.endswith(".npz"):
+        name = name[:-len(".npz")]
+    return "{}_{}".format(
+        name, os.path.splitext(os.path.basename(str(archive)))[0])
+
+
+def savez_atomic(filename, **arrays):
+    '''
+    np.savez through a temporary file renamed into place once complete.
+    '''
+    if not filename.endswith(".npz"):
+        filename += ".npz"
+    atomic_write(filename, lambda f: np.savez(f, **arrays))
+
+
+def analyse_archive(file, seed):
+    '''
+    Analyse one archive. In batch mode also returns its entries of
+    batch_params, batch_matrix_results and batch_snapshots.
+    '''
+    np.random.seed(seed)
+    params = matrix_result = snapshot_result = None
+    data = None
     try:
         start_time = plt.datetime.datetime.now()
         print "\n\nAnalysing file", str(file)
@@ -52,7 +90,7 @@ for file in paths:
             data = np.load(str(file) + ".npz")
         simdata = np.array(data['sim_params']).ravel()[0]
         if sensitivity_analysis:
-            batch_params.append((simdata, file))
+            params = (simdata, file)
 
         if 'case' in simdata:
             print "Case", simdata['case'], "analysis"
@@ -61,18 +99,19 @@ for file in paths:
         simtime = int(data['simtime'])
         post_spikes = data['post_spikes']
 
-        ff_last = data['final_pre_weights']
-        lat_last = data['final_post_weights']
-        init_ff_weights = data['init_ff_connections']
-        init_lat_weights = data['init_lat_connections']
-        ff_init = data['init_ff_connections']
-        lat_init = data['init_lat_connections']
+        ff_last = as_connection_array(data['final_pre_weights'])
+        lat_last = as_connection_array(data['final_post_weights'])
+        # Initial connections may be stored as ConnectionList records
+        init_ff_weights = as_connection_array(data['init_ff_connections'])
+        init_lat_weights = as_connection_array(data['init_lat_connections'])
+        ff_init = init_ff_weights
+        lat_init = init_lat_weights
 
         try:
             # retrieve some important sim params
             grid = simdata['grid']
             N_layer = grid[0] * grid[1]
-            n = int(np.sqrt(N_layer))
+            n = int(grid[0])
             g_max = simdata['g_max']
             s_max = simdata['s_max']
             sigma_form_forward = simdata['sigma_form_forward']
@@ -86,7 +125,7 @@ for file in paths:
             # use defaults
             grid = np.asarray([16, 16])
             N_layer = 256
-            n = 32
+            n = 16
             s_max = 16
             sigma_form_forward = 2.5
             sigma_form_lateral = 1
@@ -96,14 +135,19 @@ for file in paths:
             p_elim_pot = 1.36 * np.e ** -4
             f_rew = 10 ** 4  # Hz
             g_max = .2
+        if grid[0] != grid[1]:
+            # Receptive fields are centred and sampled on an n x n grid
+            raise ValueError("Cannot analyse {}: grid {} is not square".format(
+                file, tuple(grid)))
 
         total_target_neuron_mean_spike_rate = \
             post_spikes.shape[0] / float(simtime) * 1000. / N_layer
 
-        last_conn, last_weight = list_to_post_pre(ff_last, lat_last,
-                                                  s_max, N_layer)
-        init_conn, init_weight = list_to_post_pre(ff_init, lat_init,
-                                                  s_max, N_layer)
+        # Incoming synapses of every target, also used for the counts in (c)
+        last_csr = post_pre_csr(ff_last, lat_last, N_layer)
+        init_csr = post_pre_csr(ff_init, lat_init, N_layer)
+        last_conn, last_weight = csr_to_post_pre(last_csr, s_max)
+        init_conn, init_weight = csr_to_post_pre(init_csr, s_max)
 
         #####     #####
         ## POST AREA ##
@@ -195,10 +239,11 @@ for file in paths:
 
         # a
 
-        init_fan_in = fan_in(init_conn, init_weight, 'conn', 'ff')
+        init_fan_in = fan_in(init_conn, init_weight, 'conn', 'ff',
+                             grid=grid)
 
         mean_projection, means_and_std_devs, means_for_plot, mean_centred_projection = centre_weights(
-            init_fan_in, 16)
+            init_fan_in, n)
 
         init_mean_std = np.mean(means_and_std_devs[:, 5])
         init_mean_AD = np.mean(means_and_std_devs[:, 4])
@@ -208,9 +253,10 @@ for file in paths:
         init_conn_ff_odc = odc(init_fan_in)
 
         # b
-        final_fan_in = fan_in(last_conn, last_weight, 'conn', 'ff')
+        final_fan_in = fan_in(last_conn, last_weight, 'conn', 'ff',
+                              grid=grid)
         fin_mean_projection, fin_means_and_std_devs, fin_means_for_plot, fin_mean_centred_projection = centre_weights(
-            final_fan_in, s_max)
+            final_fan_in, n)
         fin_mean_std_conn = np.mean(fin_means_and_std_devs[:, 5])
         fin_mean_AD_conn = np.mean(fin_means_and_std_devs[:, 4])
         fin_stds_conn = fin_means_and_std_devs[:, 5]
@@ -220,42 +266,36 @@ for file in paths:
 
         # c
 
-        init_ff_connections = []
-        ff_s = np.zeros(N_layer, dtype=np.uint)
-        lat_s = np.zeros(N_layer, dtype=np.uint)
+        # number of synapses onto each post neuron, ff_last, lat_last
+        ff_s, lat_s = csr_synapse_counts(last_csr)
 
-        # populate ff_s and lat_s
-        # ff_last, lat_last
-        for post_id in range(N_layer):
-            ff_s[post_id] = ff_last[ff_last[:, 1] == post_id].shape[0]
-            lat_s[post_id] = lat_last[lat_last[:, 1] == post_id].shape[0]
+        generated_ff_conn = ConnectionList()
+        generated_lat_conn = ConnectionList()
 
-        existing_pre_ff = []
-        generated_ff_conn = []
-        generated_lat_conn = []
-
-        generate_equivalent_connectivity(
+        shuffle_seed = generate_equivalent_connectivity(
             ff_s, generated_ff_conn,
             sigma_form_forward, p_form_forward,
             "\nGenerating initial feedforward connectivity...",
-            N_layer=N_layer, n=n, g_max=g_max)
+            N_layer=N_layer, n=n, g_max=g_max, stream=FF_STREAM)
 
         generate_equivalent_connectivity(
             lat_s, generated_lat_conn,
             sigma_form_lateral, p_form_lateral,
             "\nGenerating initial lateral connectivity...",
-            N_layer=N_layer, n=n, g_max=g_max)
+            N_layer=N_layer, n=n, g_max=g_max, seed=shuffle_seed,
+            stream=LAT_STREAM)
 
         gen_init_conn, gen_init_weight = \
-            list_to_post_pre(np.asarray(generated_ff_conn),
-                             np.asarray(generated_lat_conn), s_max,
+            list_to_post_pre(as_connection_array(generated_ff_conn),
+                             as_connection_array(generated_lat_conn), s_max,
                              N_layer)
 
-        gen_fan_in = fan_in(gen_init_conn, gen_init_weight, 'conn', 'ff')
+        gen_fan_in = fan_in(gen_init_conn, gen_init_weight, 'conn', 'ff',
+                            grid=grid)
 
         fin_mean_projection_shuf, fin_means_and_std_devs_shuf, \
         fin_means_for_plot_shuf, fin_mean_centred_projection_shuf = \
-            centre_weights(gen_fan_in, s_max)
+            centre_weights(gen_fan_in, n)
 
         fin_mean_std_conn_shuf = np.mean(fin_means_and_std_devs_shuf[:, 5])
         fin_mean_AD_conn_shuf = np.mean(fin_means_and_std_devs_shuf[:, 4])
@@ -269,10 +309,10 @@ for file in paths:
             fin_AD_conn_shuf.ravel())
         # d
         final_fan_in_weight = fan_in(last_conn, last_weight, 'weight',
-                                     'ff')
+                                     'ff', grid=grid)
         # final_fan_in_weight = conn_matrix_to_fan_in(ff_last, mode='weight')
         fin_mean_projection_weight, fin_means_and_std_devs_weight, fin_means_for_plot_weight, fin_mean_centred_projection_weight = centre_weights(
-            final_fan_in_weight, s_max)
+            final_fan_in_weight, n)
         fin_mean_std_weight = np.mean(fin_means_and_std_devs_weight[:, 5])
         fin_mean_AD_weight = np.mean(fin_means_and_std_devs_weight[:, 4])
         fin_stds_weight = fin_means_and_std_devs_weight[:, 5]
@@ -283,10 +323,11 @@ for file in paths:
         # e
 
         weight_copy = weight_shuffle(last_conn, last_weight, 'ff')
-        shuf_weights = fan_in(last_conn, weight_copy, 'weight', 'ff')
+        shuf_weights = fan_in(last_conn, weight_copy, 'weight', 'ff',
+                              grid=grid)
 
         fin_mean_projection_weight_shuf, fin_means_and_std_devs_weight_shuf, fin_means_for_plot_weight_shuf, fin_mean_centred_projection_weight_shuf = centre_weights(
-            shuf_weights, s_max)
+            shuf_weights, n)
         fin_mean_std_weight_shuf = np.mean(
             fin_means_and_std_devs_weight_shuf[:, 5])
         fin_mean_AD_weight_shuf = np.mean(
@@ -312,9 +353,10 @@ for file in paths:
 
         # save fin_(stds/AD)_(conn/weight) separately for comparison between
         # lesioned example and non-lesioned
-        np.savez("std_ad_data",
-                 fin_stds_conn=fin_stds_conn, fin_AD_conn=fin_AD_conn,
-                 fin_stds_weight=fin_stds_weight, fin_AD_weight=fin_AD_weight)
+        savez_atomic(output_name("std_ad_data", file),
+                     fin_stds_conn=fin_stds_conn, fin_AD_conn=fin_AD_conn,
+                     fin_stds_weight=fin_stds_weight,
+                     fin_AD_weight=fin_AD_weight)
 
         print
         pp(simdata)
@@ -338,7 +380,7 @@ for file in paths:
         print "%-60s" % "p(WSR AD fin weight vs AD fin weight shuffle)", wsr_AD_fin_weight_fin_weight_shuffle.pvalue
 
         if sensitivity_analysis:
-            batch_matrix_results.append((
+            matrix_result = (
                 total_target_neuron_mean_spike_rate,
                 final_mean_number_ff_synapses,
                 final_weight_proportion,
@@ -357,64 +399,66 @@ for file in paths:
                 fin_mean_AD_weight,
                 wsr_AD_fin_weight_fin_weight_shuffle.pvalue,
                 file
-            ))
+            )
 
         # LAT connection bar chart
 
-        init_fan_in_rec = fan_in(init_conn, init_weight, 'conn', 'rec')
+        init_fan_in_rec = fan_in(init_conn, init_weight, 'conn', 'rec',
+                                 grid=grid)
 
         mean_projection_rec, means_and_std_devs_rec, \
         means_for_plot_rec, mean_centred_projection_rec = centre_weights(
-            init_fan_in_rec, 16)
+            init_fan_in_rec, n)
 
         init_fan_in_rec_rad = radial_sample(mean_projection_rec, 100)
 
         final_fan_in_rec = fan_in(last_conn, last_weight, 'weight',
-                                  'rec')
+                                  'rec', grid=grid)
 
         final_mean_projection_rec, final_means_and_std_devs_rec, \
         final_means_for_plot_rec, final_mean_centred_projection_rec = centre_weights(
-            final_fan_in_rec, 16)
+            final_fan_in_rec, n)
 
         final_fan_in_rec_rad = \
             radial_sample(final_mean_projection_rec, 100)
 
         final_fan_in_rec_conn = fan_in(last_conn, last_weight, 'conn',
-                                       'rec')
+                                       'rec', grid=grid)
 
         final_mean_projection_rec_conn, final_means_and_std_devs_rec_conn, \
         final_means_for_plot_rec_conn, final_mean_centred_projection_rec_conn = centre_weights(
-            final_fan_in_rec_conn, 16)
+            final_fan_in_rec_conn, n)
 
         final_fan_in_rec_rad_conn = \
             radial_sample(final_mean_projection_rec_conn, 100)
 
         ## FF connection bar chart
 
-        init_fan_in_ff = fan_in(init_conn, init_weight, 'conn', 'ff')
+        init_fan_in_ff = fan_in(init_conn, init_weight, 'conn', 'ff',
+                                grid=grid)
 
         mean_projection_ff, means_and_std_devs_ff, \
         means_for_plot_ff, mean_centred_projection_ff = centre_weights(
-            init_fan_in_ff, 16)
+            init_fan_in_ff, n)
 
         init_fan_in_ff_rad = radial_sample(mean_projection_ff, 100)
 
         final_fan_in_ff = fan_in(last_conn, last_weight, 'weight',
-                                 'ff')
+                                 'ff', grid=grid)
 
         final_mean_projection_ff, final_means_and_std_devs_ff, \
         final_means_for_plot_ff, final_mean_centred_projection_ff = centre_weights(
-            final_fan_in_ff, 16)
+            final_fan_in_ff, n)
 
         final_fan_in_ff_rad = \
             radial_sample(final_mean_projection_ff, 100)
 
         final_fan_in_ff_conn = fan_in(last_conn, last_weight, 'conn',
-                                      'ff')
+                                      'ff', grid=grid)
 
         final_mean_projection_ff_conn, final_means_and_std_devs_ff_conn, \
         final_means_for_plot_ff_conn, final_mean_centred_projection_ff_conn = centre_weights(
-            final_fan_in_ff_conn, 16)
+            final_fan_in_ff_conn, n)
 
         final_fan_in_ff_rad_conn = \
             radial_sample(final_mean_projection_ff_conn, 100)
@@ -433,7 +477,7 @@ for file in paths:
         else:
             filename = "analysis" + str(suffix)
 
-        np.savez(filename, recording_archive_name=file,
+        savez_atomic(output_name(filename, file), recording_archive_name=file,
                  target_neurom_mean_spike_rate=total_target_neuron_mean_spike_rate,
                  final_mean_number_ff_synapses=final_mean_number_ff_synapses,
                  final_weight_proportion=final_weight_proportion,
@@ -490,11 +534,11 @@ for file in paths:
 
         if args.plot and not sensitivity_analysis:
 
-            final_ff_weight_network = np.ones((256, 256)) * np.nan
-            final_lat_weight_network = np.ones((256, 256)) * np.nan
+            final_ff_weight_network = np.ones((N_layer, N_layer)) * np.nan
+            final_lat_weight_network = np.ones((N_layer, N_layer)) * np.nan
 
-            final_ff_conn_network = np.ones((256, 256)) * np.nan
-            final_lat_conn_network = np.ones((256, 256)) * np.nan
+            final_ff_conn_network = np.ones((N_layer, N_layer)) * np.nan
+            final_lat_conn_network = np.ones((N_layer, N_layer)) * np.nan
             for source, target, weight, delay in ff_last:
                 if np.isnan(final_ff_weight_network[int(source), int(target)]):
                     final_ff_weight_network[int(source), int(target)] = weight
@@ -676,11 +720,18 @@ for file in paths:
 
         if args.snapshots:
 
-            all_ff_connections = data['ff_connections']
-            all_lat_connections = data['lat_connections']
+            snapshot_store = None
+            if 'snapshot_dir' in data.files and \
+                    data['snapshot_dir'].item() is not None:
+                # Snapshots were streamed to disk, each is read when needed
+                snapshot_store = SnapshotStore(data['snapshot_dir'].item())
+                number_of_recordings = len(snapshot_store)
+            else:
+                all_ff_connections = data['ff_connections']
+                all_lat_connections = data['lat_connections']
+                number_of_recordings = all_ff_connections.shape[0]
             if data:
                 data.close()
-            number_of_recordings = all_ff_connections.shape[0]
             all_mean_sigmas = np.ones(number_of_recordings) * np.nan
             all_mean_ADs = np.ones(number_of_recordings) * np.nan
 
@@ -689,24 +740,31 @@ for file in paths:
 
             all_mean_s = np.zeros(number_of_recordings)
             for index in range(number_of_recordings):
+                if snapshot_store is not None:
+                    ff_snapshot, lat_snapshot = snapshot_store[index]
+                else:
+                    ff_snapshot = all_ff_connections[index]
+                    lat_snapshot = all_lat_connections[index]
                 conn, weight = \
-                    list_to_post_pre(all_ff_connections[index],
-                                     all_lat_connections[index], 16,
-                                     N_layer)
+                    list_to_post_pre(as_connection_array(ff_snapshot),
+                                     as_connection_array(lat_snapshot),
+                                     s_max, N_layer)
 
-                current_fan_in = fan_in(conn, weight, 'weight', 'ff')
+                current_fan_in = fan_in(conn, weight, 'weight', 'ff',
+                                        grid=grid)
                 mean_projection, means_and_std_devs, means_for_plot, mean_centred_projection = centre_weights(
-                    current_fan_in, 16)
+                    current_fan_in, n)
 
                 all_mean_sigmas[index] = np.mean(means_and_std_devs[:, 5])
                 all_mean_ADs[index] = np.mean(means_and_std_devs[:, 4])
 
                 all_mean_s[index] = conn[conn != -1].size / float(N_layer)
 
-                current_fan_in_conn = fan_in(conn, weight, 'conn', 'ff')
+                current_fan_in_conn = fan_in(conn, weight, 'conn', 'ff',
+                                             grid=grid)
                 mean_projection_conn, means_and_std_devs_conn, \
                 means_for_plot_conn, mean_centred_projection_conn = centre_weights(
-                    current_fan_in_conn, 16)
+                    current_fan_in_conn, n)
 
                 all_mean_sigmas_conn[index] = np.mean(
                     means_and_std_devs_conn[:, 5])
@@ -719,19 +777,20 @@ for file in paths:
                 #     resolution=args.resolution)
                 # all_mean_sigmas[index] = mean_std
                 # all_mean_ADs[index] = mean_AD
-            np.savez("last_std_ad_evo", recording_archive_name=file,
-                     all_mean_sigmas=all_mean_sigmas,
-                     all_mean_ads=all_mean_ADs,
-                     all_mean_sigmas_conn=all_mean_sigmas_conn,
-                     all_mean_ads_conn=all_mean_ADs_conn)
+            savez_atomic(output_name("last_std_ad_evo", file),
+                         recording_archive_name=file,
+                         all_mean_sigmas=all_mean_sigmas,
+                         all_mean_ads=all_mean_ADs,
+                         all_mean_sigmas_conn=all_mean_sigmas_conn,
+                         all_mean_ads_conn=all_mean_ADs_conn)
             if sensitivity_analysis:
-                batch_snapshots.append((
+                snapshot_result = (
                     np.copy(all_mean_sigmas),
                     np.copy(all_mean_ADs),
                     np.copy(all_mean_sigmas_conn),
                     np.copy(all_mean_ADs_conn),
                     file
-                ))
+                )
             if args.plot and not sensitivity_analysis:
                 plt.plot(all_mean_sigmas)
                 plt.ylim([0, 1.1 * np.max(all_mean_sigmas)])
@@ -765,16 +824,46 @@ for file in paths:
 
     except IOError as e:
         print "IOError:", e
-    except MemoryError:
+    except MemoryError as e:
         print "Out of memory. Did you use HDF5 slices to read in data?", e
     finally:
-        data.close()
+        if data is not None:
+            data.close()
+    return params, matrix_result, snapshot_result
+
+
+def _analyse_archive(job):
+    return analyse_archive(*job)
+
+
+jobs = list(zip(paths, archive_seeds))
+if sensitivity_analysis and args.processes != 1:
+    # Archives are independent: analyse them on a pool of workers. map
+    # returns the results in the order of paths whichever worker finishes
+    # first
+    pool = Pool(args.processes)
+    try:
+        results = pool.map(_analyse_archive, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+else:
+    results = [_analyse_archive(job) for job in jobs]
 
 if sensitivity_analysis:
+    for params, matrix_result, snapshot_result in results:
+        if params is not None:
+            batch_params.append(params)
+        if matrix_result is not None:
+            batch_matrix_results.append(matrix_result)
+        if snapshot_result is not None:
+            batch_snapshots.append(snapshot_result)
+
     curr_time = plt.datetime.datetime.now()
     suffix_total = curr_time.strftime("_%H%M%S_%d%m%Y")
-    np.savez("batch_analysis" + suffix_total, recording_archive_name=file,
-             snapshots=batch_snapshots,
-             params=batch_params,
-             results=batch_matrix_results
-             )
+    savez_atomic("batch_analysis" + suffix_total,
+                 recording_archive_name=paths,
+                 snapshots=batch_snapshots,
+                 params=batch_params,
+                 results=batch_matrix_results
+                 )
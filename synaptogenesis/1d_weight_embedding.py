@@ -80,6 +80,9 @@ tau_plus = 20.  # ms
 tau_minus = 10.  # ms
 a_minus = (a_plus * tau_plus * b) / tau_minus
 
+# Connectivity generation
+seed = args.seed if args.seed is not None else new_seed()
+
 # Reporting
 
 sim_params = {'g_max': g_max,
@@ -101,7 +104,8 @@ sim_params = {'g_max': g_max,
               'p_elim_pot': p_elim_pot,
               'f_rew': f_rew,
               'lateral_inhibition':args.lateral_inhibition,
-              'b':b
+              'b':b,
+              'seed': seed
               }
 
 # +-------------------------------------------------------------------+
@@ -166,7 +170,9 @@ source_pop = sim.Population(N_layer,
                              'duration': simtime
                              }, label="Poisson spike source")
 
-ff_prob_conn = [(i, j, g_max, args.delay) for i in range(N_layer) for j in range(N_layer) if np.random.rand() < .05]
+ff_prob_conn = fixed_probability_connections(N_layer, N_layer, .05, g_max,
+                                             args.delay,
+                                             rng=block_rng(seed, FF_STREAM, 0))
 
 ff_projection = sim.Projection(
     source_pop, target_pop,
@@ -189,6 +195,15 @@ pre_weights = []
 post_weights = []
 
 
+snapshot_store = None
+if args.snapshot_dir:
+    snapshot_store = SnapshotStore(args.snapshot_dir, names=('ff',),
+                                   keep_recent=args.snapshot_keep_recent,
+                                   thin_stride=args.snapshot_thin_stride,
+                                   mode='w',
+                                   overwrite=args.snapshot_overwrite)
+snapshot_buffer = SnapshotBuffer()
+
 no_runs = simtime // t_record
 run_duration = t_record
 
@@ -197,12 +212,14 @@ for current_run in range(no_runs):
     sim.run(run_duration)
 
     # Retrieve data
-    pre_weights.append(
-        np.array([
-            ff_projection._get_synaptic_data(True, 'source'),
-            ff_projection._get_synaptic_data(True, 'target'),
-            ff_projection._get_synaptic_data(True, 'weight'),
-            ff_projection._get_synaptic_data(True, 'delay')]).T)
+    snapshot = snapshot_buffer.extract([ff_projection])
+    if snapshot_store is not None:
+        snapshot_store.append((current_run + 1) * run_duration, snapshot)
+        # Only the latest snapshot stays in memory, as views of the buffer
+        del pre_weights[:]
+    else:
+        snapshot = snapshot_buffer.copies()
+    pre_weights.append(snapshot[0])
 
 if args.record_source:
     pre_spikes = source_pop.getSpikes(compatible_output=True)
@@ -236,6 +253,8 @@ np.savez(filename, pre_spikes=pre_spikes,
          lat_connections=None,
          final_pre_weights=pre_weights[-1],
          final_post_weights=None,
+         snapshot_dir=(snapshot_store.directory
+                       if snapshot_store is not None else None),
          simtime=simtime,
          sim_params=sim_params,
          total_time=total_time,
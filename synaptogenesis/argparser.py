@@ -22,6 +22,10 @@ DEFAULT_N = 16
 
 DEFAULT_DELAY = 1
 
+DEFAULT_PROCESSES = 1
+
+DEFAULT_MNIST_CACHE_DIR = "mnist_input_rates/decoded_cache"
+
 DEFAULT_SPIKE_SOURCE = SSP
 DEFAULT_B = 1.2
 DEFAULT_T_MINUS = 64
@@ -51,6 +55,9 @@ ONE_TO_ONE_LESION = 2
 # Enable latero-lateral interaction
 DEFAULT_LAT_LAT_CONN = False
 
+# Of the thinned weight snapshots, keep one in DEFAULT_SNAPSHOT_THIN_STRIDE
+DEFAULT_SNAPSHOT_THIN_STRIDE = 10
+
 
 parser = argparse.ArgumentParser(
     description='Test for topographic map formation using STDP and synaptic rewiring'
@@ -153,6 +160,47 @@ parser.add_argument('--no_iterations', type=int,
                     default=DEFAULT_NO_INTERATIONS, dest='no_iterations',
                     help='total number of iterations (or time steps) for the simulation (technically, ms)')
 
+parser.add_argument('--seed', type=int, dest='seed',
+                    help='seed for generating the initial connectivity and '
+                         'the MNIST rate noise. It is recorded in sim_params '
+                         'so the same network and inputs can be regenerated '
+                         '(random if not provided)')
+
+parser.add_argument('--processes', type=int,
+                    default=DEFAULT_PROCESSES, dest='processes',
+                    help='number of worker processes used to generate '
+                         'connectivity. The result does not depend on it')
+
+parser.add_argument('--mnist_cache_dir', type=str,
+                    default=DEFAULT_MNIST_CACHE_DIR, dest='mnist_cache_dir',
+                    help='directory where decoded MNIST rates are cached '
+                         'between runs')
+
+parser.add_argument('--shared_mnist_rates',
+                    help='share decoded MNIST rates in memory (/dev/shm) '
+                         'with other simulations running on this host',
+                    action="store_true")
+
+parser.add_argument('--snapshot_dir', type=str, dest='snapshot_dir',
+                    help='write every weight snapshot to this directory as '
+                         'soon as it is taken, instead of keeping them all '
+                         'in memory until the end of the run')
+
+parser.add_argument('--snapshot_keep_recent', type=int,
+                    dest='snapshot_keep_recent',
+                    help='keep only this many recent snapshots at full '
+                         'resolution in --snapshot_dir and thin older ones')
+
+parser.add_argument('--snapshot_thin_stride', type=int,
+                    default=DEFAULT_SNAPSHOT_THIN_STRIDE,
+                    dest='snapshot_thin_stride',
+                    help='every how many snapshots one is kept once thinned')
+
+parser.add_argument('--snapshot_overwrite', action="store_true",
+                    dest='snapshot_overwrite',
+                    help='replace the snapshots of an earlier run in '
+                         '--snapshot_dir rather than refusing to start')
+
 parser.add_argument('--plot', help="display plots",
                     action="store_true")
 
@@ -197,4 +245,10 @@ parser.add_argument('--lat_lat_conn',
                          "connectivity", default=DEFAULT_LAT_LAT_CONN,
                     action="store_true")
 
+parser.add_argument('--merged_columns',
+                    help="in testing mode, build the ten digit columns as "
+                         "one population with block-structured projections "
+                         "instead of one population and projection per digit",
+                    action="store_true")
+
 args = parser.parse_args()
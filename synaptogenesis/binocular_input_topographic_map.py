@@ -12,6 +12,7 @@ from pacman.model.constraints.placer_constraints.placer_chip_and_core_constraint
 import spynnaker7.pyNN as sim
 
 from function_definitions import *
+from rate_schedules import *
 from argparser import *
 
 case = args.case
@@ -122,8 +123,10 @@ sim_params = {'g_max': g_max,
 
 if args.gaussian_input:
     gen_rate = generate_gaussian_input_rates
+    rate_kind = GAUSSIAN_RATES
 else:
     gen_rate = generate_rates
+    rate_kind = POINTY_RATES
 
 # +-------------------------------------------------------------------+
 # | Initial network setup                                             |
@@ -143,23 +146,25 @@ if case == CASE_REW_NO_CORR:
 
 elif case == CASE_CORR_AND_REW or case == CASE_CORR_NO_REW:
 
-    rates = np.empty((simtime // t_stim, grid[0], grid[1]))
-    for rate_id in range(simtime // t_stim):
-        rand_offset = np.random.randint(0, N_layer//2)
-        stim_position = (positions[rate_id%2][0][rand_offset], positions[rate_id%2][1][rand_offset])
-        assert binoc_positions[stim_position] == rate_id%2
-        r = gen_rate(stim_position,
-                     f_base=f_base,
-                     grid=grid,
-                     f_peak=f_peak,
-                     sigma_stim=sigma_stim)
-
-        rates[rate_id, :, :] = r
-    rates = rates.reshape(simtime // t_stim, N_layer)
+    # Alternate between left and right eye positions on consecutive frames
+    eye_positions = np.asarray(positions)
+    eyes = np.arange(simtime // t_stim) % 2
+    rand_offsets = np.random.randint(0, N_layer // 2, size=eyes.size)
+    stim_positions = eye_positions[eyes, :, rand_offsets]
+    assert np.all(binoc_positions[stim_positions[:, 0],
+                                  stim_positions[:, 1]] == eyes)
+    # Rates are stored quantised and only expanded, to float32, when handed
+    # to the source
+    rate_schedule = RateSchedule.from_centres(stim_positions, rate_kind,
+                                              t_stim,
+                                              f_base=f_base,
+                                              grid=grid,
+                                              f_peak=f_peak,
+                                              sigma_stim=sigma_stim)
 
     source_pop = sim.Population(N_layer,
                                 sim.SpikeSourcePoissonVariable,
-                                {'rate': rates,
+                                {'rate': rate_schedule.rates(dtype=np.float32),
                                  'start': 100,
                                  'duration': simtime,
                                  'rate_interval_duration': t_stim
@@ -168,8 +173,8 @@ elif case == CASE_CORR_AND_REW or case == CASE_CORR_NO_REW:
 ff_s = np.zeros(N_layer, dtype=np.uint)
 lat_s = np.zeros(N_layer, dtype=np.uint)
 
-init_ff_connections = []
-init_lat_connections = []
+init_ff_connections = ConnectionList()
+init_lat_connections = ConnectionList()
 
 if args.initial_connectivity_file is None:
     raise NotImplementedError
@@ -183,17 +188,8 @@ else:
     conn = initial_connectivity['ConnPostToPre'] - 1
     weight = initial_connectivity['WeightPostToPre']
 
-    for target in range(conn.shape[1]):
-        for index in range(conn.shape[0]):
-            if conn[index, target] >= 0:
-                if conn[index, target] < N_layer:
-                    init_ff_connections.append(
-                        (conn[index, target], target,
-                         weight[index, target], 1))
-                else:
-                    init_lat_connections.append(
-                        (conn[index, target] - N_layer, target,
-                         weight[index, target], 1))
+    init_ff_connections, init_lat_connections = post_pre_to_connections(
+        conn, weight, N_layer)
 
 # Neuron populations
 target_pop = sim.Population(N_layer, model, cell_params, label="TARGET_POP")
@@ -280,6 +276,15 @@ post_delays = []
 e = None
 print "Starting the sim"
 
+snapshot_store = None
+if args.snapshot_dir:
+    snapshot_store = SnapshotStore(args.snapshot_dir, names=('ff', 'lat'),
+                                   keep_recent=args.snapshot_keep_recent,
+                                   thin_stride=args.snapshot_thin_stride,
+                                   mode='w',
+                                   overwrite=args.snapshot_overwrite)
+snapshot_buffer = SnapshotBuffer()
+
 no_runs = simtime // t_record
 run_duration = t_record
 
@@ -289,18 +294,18 @@ try:
         sim.run(run_duration)
 
         if (current_run + 1) * run_duration % t_record == 0:
-            pre_weights.append(
-                np.array([
-                    ff_projection._get_synaptic_data(True, 'source'),
-                    ff_projection._get_synaptic_data(True, 'target'),
-                    ff_projection._get_synaptic_data(True, 'weight'),
-                    ff_projection._get_synaptic_data(True, 'delay')]).T)
-            post_weights.append(
-                np.array([
-                    lat_projection._get_synaptic_data(True, 'source'),
-                    lat_projection._get_synaptic_data(True, 'target'),
-                    lat_projection._get_synaptic_data(True, 'weight'),
-                    lat_projection._get_synaptic_data(True, 'delay')]).T)
+            snapshot = snapshot_buffer.extract([ff_projection,
+                                                lat_projection])
+            if snapshot_store is not None:
+                snapshot_store.append((current_run + 1) * run_duration,
+                                      snapshot)
+                # Only the latest snapshot stays in memory, as views of the
+                # buffer
+                del pre_weights[:], post_weights[:]
+            else:
+                snapshot = snapshot_buffer.copies()
+            pre_weights.append(snapshot[0])
+            post_weights.append(snapshot[1])
     if args.record_source:
         pre_spikes = source_pop.getSpikes(compatible_output=True)
     else:
@@ -337,6 +342,8 @@ np.savez(filename, pre_spikes=pre_spikes,
          lat_connections=post_weights,
          final_pre_weights=pre_weights[-1],
          final_post_weights=post_weights[-1],
+         snapshot_dir=(snapshot_store.directory
+                       if snapshot_store is not None else None),
          simtime=simtime,
          sim_params=sim_params,
          total_time=total_time,
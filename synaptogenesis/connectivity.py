@@ -0,0 +1,358 @@
+from multiprocessing import Pool
+
+import numpy as np
+
+from geometry import squared_distance_table
+
+# +-------------------------------------------------------------------+
+# | Distance-dependent connectivity                                   |
+# +-------------------------------------------------------------------+
+
+
+# Random streams are spawned per block of BLOCK_SIZE postsynaptic neurons from
+# a single recorded seed. Block boundaries do not depend on the number of
+# worker processes, so the generated network is bit-identical however the
+# work is split.
+BLOCK_SIZE = 64
+MAX_SEED = 2 ** 31 - 1
+
+# Stream ids, so that projections generated from the same seed do not share
+# random numbers
+FF_STREAM = 0
+LAT_STREAM = 1
+# Stream of the MNIST rate noise seed
+MNIST_NOISE_STREAM = 2
+
+
+# Above this connection probability sample_bernoulli_pairs tests every pair
+# rather than redrawing duplicate partners
+DENSE_BERNOULLI_P = .5
+
+# Packed record for one synapse: 13 bytes instead of a Python tuple of four
+# numbers. Field names match what FromListConnector expects.
+CONNECTION_DTYPE = np.dtype([('source', '<i4'),
+                             ('target', '<i4'),
+                             ('weight', '<f4'),
+                             ('delay', 'u1')])
+
+
+def _rng(rng):
+    return np.random if rng is None else rng
+
+
+def new_seed():
+    '''
+    Fresh seed drawn from the global numpy random state, to be recorded in
+    sim_params so the network can be regenerated.
+    '''
+    return int(np.random.randint(0, MAX_SEED))
+
+
+def block_rng(seed, stream, block):
+    '''
+    Independent random stream for one block of postsynaptic neurons.
+    '''
+    return np.random.RandomState([int(seed), int(stream), int(block)])
+
+
+def stream_seed(seed, stream):
+    '''
+    Seed for a random number consumer outside the connectivity blocks, e.g.
+    MnistRateStore, derived from the recorded seed and a stream id.
+    '''
+    return int(block_rng(seed, stream, 0).randint(0, MAX_SEED))
+
+
+class ConnectionList(object):
+    '''
+    Growable list of (source, target, weight, delay) connections backed by a
+    structured NumPy array with amortized appends. Indexing returns records,
+    iterating yields tuples and np.asarray returns the structured array without
+    copying, so it can be handed to FromListConnector, plotted and saved with
+    np.savez like the tuple lists it replaces.
+    '''
+
+    def __init__(self, capacity=0, data=None):
+        if data is not None:
+            self._data = data
+            self._size = data.shape[0]
+        else:
+            self._data = np.empty(capacity, dtype=CONNECTION_DTYPE)
+            self._size = 0
+
+    @classmethod
+    def from_arrays(cls, source, target, weight, delay):
+        source = np.asarray(source)
+        connections = cls(capacity=source.size)
+        connections.extend_arrays(source, target, weight, delay)
+        return connections
+
+    @classmethod
+    def load(cls, filename, mmap_mode='r'):
+        '''
+        Open connections saved with save. By default the file is memory mapped
+        read-only rather than read into memory.
+        '''
+        data = np.load(filename, mmap_mode=mmap_mode)
+        if data.dtype != CONNECTION_DTYPE:
+            data = as_connection_records(data)
+        return cls(data=data)
+
+    def save(self, filename):
+        np.save(filename, self.array)
+
+    @property
+    def array(self):
+        return self._data[:self._size]
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def __iter__(self):
+        for connection in self.array:
+            yield tuple(connection)
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.array
+        return self.array.astype(dtype)
+
+    def _reserve(self, extra):
+        required = self._size + extra
+        if required > self._data.shape[0] or not self._data.flags.writeable:
+            capacity = max(required, 2 * self._data.shape[0], 16)
+            data = np.empty(capacity, dtype=CONNECTION_DTYPE)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+
+    def clear(self):
+        '''
+        Drop all connections, keeping the allocated capacity.
+        '''
+        self._size = 0
+
+    def append(self, connection):
+        self.extend_arrays(*[[field] for field in connection])
+
+    def extend(self, connections):
+        records = as_connection_records(connections)
+        self._reserve(records.size)
+        self._data[self._size:self._size + records.size] = records
+        self._size += records.size
+
+    def extend_arrays(self, source, target, weight, delay):
+        source = np.asarray(source).ravel()
+        self._reserve(source.size)
+        added = self._data[self._size:self._size + source.size]
+        added['source'] = source
+        added['target'] = target
+        added['weight'] = weight
+        added['delay'] = delay
+        self._size += source.size
+
+
+def as_connection_records(connections):
+    '''
+    Connections as CONNECTION_DTYPE records, from a ConnectionList, a sequence
+    of (source, target, weight, delay) tuples or records, or an (N, 4) array.
+    Records that already have CONNECTION_DTYPE are returned as they are.
+    '''
+    if isinstance(connections, ConnectionList):
+        return connections.array
+    connections = np.asarray(connections)
+    if connections.dtype == CONNECTION_DTYPE:
+        return connections
+    if connections.dtype.names:
+        records = np.empty(connections.shape[0], dtype=CONNECTION_DTYPE)
+        for index, name in enumerate(CONNECTION_DTYPE.names):
+            records[name] = connections[connections.dtype.names[index]]
+        return records
+    connections = connections.astype(float).reshape(-1, 4)
+    records = np.empty(connections.shape[0], dtype=CONNECTION_DTYPE)
+    for index, name in enumerate(CONNECTION_DTYPE.names):
+        records[name] = connections[:, index]
+    return records
+
+
+def as_connection_array(connections):
+    '''
+    Connections as an (N, 4) float array of (source, target, weight, delay)
+    rows, whether they were stored as structured records or as rows.
+    '''
+    if isinstance(connections, ConnectionList):
+        connections = connections.array
+    connections = np.asarray(connections)
+    if connections.dtype.names:
+        return np.column_stack([connections[name].astype(float)
+                                for name in connections.dtype.names[:4]])
+    if connections.size == 0:
+        return np.zeros((0, 4))
+    return connections
+
+
+def add_connections(connections, source, target, weight, delay):
+    '''
+    Append arrays of connections to a ConnectionList or to a list of tuples.
+    '''
+    if isinstance(connections, ConnectionList):
+        connections.extend_arrays(source, target, weight, delay)
+    else:
+        source = np.asarray(source)
+        connections.extend(zip(source.tolist(), np.asarray(target).tolist(),
+                               [weight] * source.size,
+                               [delay] * source.size))
+
+
+def post_pre_to_connections(conn, weight, N_layer, delay=1):
+    '''
+    Split a (2 * s_max, N_layer) ConnPostToPre table, as stored in the .mat
+    and .npz initial connectivity files, into feedforward and lateral
+    ConnectionLists. Empty slots hold negative ids, lateral sources are offset
+    by N_layer.
+    '''
+    # Traverse target by target, like the tables are laid out
+    conn = np.asarray(conn).T
+    weight = np.asarray(weight).T
+    targets = np.repeat(np.arange(conn.shape[0]), conn.shape[1]).reshape(
+        conn.shape)
+    ff = np.logical_and(conn >= 0, conn < N_layer)
+    lat = conn >= N_layer
+    return (ConnectionList.from_arrays(conn[ff], targets[ff], weight[ff],
+                                       delay),
+            ConnectionList.from_arrays(conn[lat] - N_layer, targets[lat],
+                                       weight[lat], delay))
+
+
+def one_to_one_connections(N_layer, weight, delay):
+    ids = np.arange(N_layer)
+    return ConnectionList.from_arrays(ids, ids, weight, delay)
+
+
+def sample_bernoulli_pairs(N_pre, N_post, p_connect, rng=None):
+    '''
+    (pre, post) arrays of the pairs kept when every one of the N_pre x N_post
+    pairs is kept independently with probability p_connect, sorted by pre and
+    then post.
+
+    The number of partners of every pre neuron is drawn from a binomial and
+    distinct partners are then drawn uniformly, redrawing duplicates, so only
+    about as many random numbers as kept pairs are needed. Dense
+    probabilities fall back to testing every pair.
+    '''
+    rng = _rng(rng)
+    if p_connect >= DENSE_BERNOULLI_P:
+        pre, post = np.nonzero(rng.rand(N_pre, N_post) < p_connect)
+        return pre.astype(np.int64), post.astype(np.int64)
+    counts = rng.binomial(N_post, max(p_connect, 0.), size=N_pre)
+    pre = np.repeat(np.arange(N_pre, dtype=np.int64), counts)
+    post = rng.randint(0, N_post, size=pre.size).astype(np.int64)
+    while True:
+        keys = pre * N_post + post
+        order = np.argsort(keys, kind='mergesort')
+        # The first occurrence of a pair is kept, later ones are redrawn
+        duplicate = np.zeros(keys.size, dtype=bool)
+        duplicate[order[1:]] = keys[order[1:]] == keys[order[:-1]]
+        no_duplicates = np.count_nonzero(duplicate)
+        if no_duplicates == 0:
+            break
+        post[duplicate] = rng.randint(0, N_post, size=no_duplicates)
+    keys.sort()
+    return keys // N_post, keys % N_post
+
+
+def fixed_probability_connections(N_pre, N_post, p_connect, weight, delay,
+                                  rng=None):
+    '''
+    Connect every (pre, post) pair independently with probability p_connect.
+    '''
+    pre, post = sample_bernoulli_pairs(N_pre, N_post, p_connect, rng=rng)
+    return ConnectionList.from_arrays(pre, post, weight, delay)
+
+
+def formation_probabilities(sigma, p_form, grid=np.asarray([16, 16]),
+                            post_ids=slice(None)):
+    '''
+    (N_pre, N_post) probability that formation_rule accepts a potential
+    presynaptic partner for a given postsynaptic neuron, optionally only for
+    the postsynaptic neurons selected by post_ids.
+    '''
+    d2 = squared_distance_table(grid)[:, post_ids]
+    return np.minimum(p_form * np.exp(-d2 / (2 * (sigma ** 2))), 1.)
+
+
+def sample_presynaptic_partners(counts, probabilities, rng=None):
+    '''
+    For every postsynaptic neuron j draw counts[j] presynaptic partners, with
+    replacement, from the categorical distribution proportional to
+    probabilities[:, j].
+
+    This is exactly the distribution produced by repeatedly picking a uniform
+    random presynaptic neuron and keeping it if formation_rule accepts it, but
+    all partners of all neurons are drawn in one vectorized pass.
+
+    Returns (pre, post) arrays, grouped by ascending post.
+    '''
+    rng = _rng(rng)
+    counts = np.asarray(counts).astype(np.int64)
+    N_pre, N_post = probabilities.shape
+    post = np.repeat(np.arange(N_post), counts)
+    if post.size == 0:
+        return np.zeros(0, dtype=np.int64), post
+
+    cdf = np.cumsum(probabilities.T, axis=1)
+    totals = cdf[:, -1]
+    if np.any(totals[counts > 0] <= 0):
+        raise ValueError("Some postsynaptic neurons can never form a synapse")
+    # Shift each normalised row by its index so that one searchsorted over the
+    # flattened table serves every postsynaptic neuron
+    cdf /= np.where(totals > 0, totals, 1.)[:, None]
+    cdf += np.arange(N_post)[:, None]
+    draws = rng.uniform(size=post.size) + post
+    pre = np.searchsorted(cdf.ravel(), draws, side='right') - post * N_pre
+    return np.clip(pre, 0, N_pre - 1), post
+
+
+def _sample_block(job):
+    seed, stream, block, start, counts, sigma, p_form, grid = job
+    probabilities = formation_probabilities(
+        sigma, p_form, grid, post_ids=slice(start, start + counts.size))
+    pre, post = sample_presynaptic_partners(
+        counts, probabilities, rng=block_rng(seed, stream, block))
+    return pre, post + start
+
+
+def sample_connectivity(counts, sigma, p_form, grid, seed, stream=FF_STREAM,
+                        processes=None, block_size=BLOCK_SIZE):
+    '''
+    Draw counts[j] presynaptic partners for every postsynaptic neuron j, block
+    by block, each block with its own random stream derived from seed. With
+    processes > 1 the blocks are shared across a process pool; the result is
+    the same for any number of processes.
+
+    Returns (pre, post) arrays, grouped by ascending post.
+    '''
+    counts = np.asarray(counts).astype(np.int64)
+    jobs = [(seed, stream, block, start, counts[start:start + block_size],
+             sigma, p_form, np.asarray(grid))
+            for block, start in enumerate(range(0, counts.size, block_size))]
+    if processes is not None and processes > 1 and len(jobs) > 1:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_sample_block, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_sample_block(job) for job in jobs]
+    if not results:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    return (np.concatenate([pre for pre, _ in results]),
+            np.concatenate([post for _, post in results]))
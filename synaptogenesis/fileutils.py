@@ -0,0 +1,56 @@
+import errno
+import os
+from tempfile import mkstemp
+
+# +-------------------------------------------------------------------+
+# | File helpers                                                      |
+# +-------------------------------------------------------------------+
+
+# The process umask, read once: setting it to read it back is not thread safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+try:
+    _replace = os.replace
+except AttributeError:
+    # Python 2: rename overwrites an existing target everywhere but Windows
+    def _replace(src, dst):
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def makedirs(path):
+    '''
+    os.makedirs that does nothing if path already exists.
+    '''
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def atomic_write(filename, write):
+    '''
+    Call write with a binary file object and move what it wrote to filename
+    once complete, so a concurrent reader never sees a partially written
+    file. The file gets the permissions open() would have given it. Under
+    Python 2 on Windows the old file is removed just before the new one is
+    moved in, so a reader can briefly find neither.
+    '''
+    fd, tmp_filename = mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        # mkstemp creates the file owner-only
+        os.chmod(tmp_filename, 0o666 & ~_UMASK)
+        _replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
@@ -1,5 +1,13 @@
 import numpy as np
-from spinn_utilities.progress_bar import ProgressBar
+
+from geometry import distance, distance_to_grid, squared_distance_to_grid
+from connectivity import FF_STREAM, LAT_STREAM, MNIST_NOISE_STREAM, \
+    ConnectionList, add_connections, as_connection_array, block_rng, \
+    fixed_probability_connections, new_seed, one_to_one_connections, \
+    post_pre_to_connections, sample_connectivity, stream_seed
+from merged_columns import ColumnLayout, block_diagonal, \
+    cross_column_one_to_one, split_spikes
+from snapshots import SnapshotBuffer, SnapshotStore, read_synaptic_data
 
 
 # +-------------------------------------------------------------------+
@@ -7,25 +15,6 @@ from spinn_utilities.progress_bar import ProgressBar
 # +-------------------------------------------------------------------+
 
 
-# Periodic boundaries
-
-def distance(x0, x1, grid=np.asarray([16, 16]), type='euclidian'):
-    x0 = np.asarray(x0)
-    x1 = np.asarray(x1)
-    delta = np.abs(x0 - x1)
-    #     delta = np.where(delta > grid * .5, delta - grid, delta)
-    #     print delta, grid
-    if delta[0] > grid[0] * .5 and grid[0] > 0:
-        delta[0] -= grid[0]
-
-    if delta[1] > grid[1] * .5 and grid[1] > 0:
-        delta[1] -= grid[1]
-
-    if type == 'manhattan':
-        return np.abs(delta).sum(axis=-1)
-    return np.sqrt((delta ** 2).sum(axis=-1))
-
-
 # Poisson spike source as from list spike source
 # https://github.com/project-rig/pynn_spinnaker_bcpnn/blob/master/examples/modular_attractor/network.py#L115-L148
 def poisson_generator(rate, t_start, t_stop):
@@ -72,12 +61,8 @@ def generate_rates(s, grid, f_base=5., f_peak=152.8, sigma_stim=2.,
     each cell has a value corresponding to the firing rate for the neuron
     at that position.
     '''
-    _rates = np.empty(grid)
-    for x in range(grid[0]):
-        for y in range(grid[1]):
-            _d = distance(s, (x, y), grid)
-            _rates[x, y] = f_base + (f_peak * (np.exp(
-                (-_d * 2) / (sigma_stim ** 2))))
+    _d = distance_to_grid(s, grid)
+    _rates = f_base + (f_peak * (np.exp((-_d * 2) / (sigma_stim ** 2))))
     return _rates
 
 
@@ -88,12 +73,8 @@ def generate_gaussian_input_rates(s, grid, f_base=5., f_peak=152.8,
     each cell has a value corresponding to the firing rate for the neuron
     at that position.
     '''
-    _rates = np.empty(grid)
-    for x in range(grid[0]):
-        for y in range(grid[1]):
-            _d = distance(s, (x, y), grid)
-            _rates[x, y] = f_peak * (np.exp(
-                (-_d ** 2) / (sigma_stim ** 2 * 2)))
+    _d2 = squared_distance_to_grid(s, grid)
+    _rates = f_peak * (np.exp(-_d2 / (sigma_stim ** 2 * 2)))
 
     means_ratio = float(f_mean - f_base) / np.mean(_rates)
     _rates = _rates * means_ratio + f_base
@@ -113,15 +94,10 @@ def generate_multimodal_gaussian_rates(s, grid, f_base=5, f_peak=152.8,
     '''
     _rates = np.zeros(grid)
     for pos in s:
-        for x in range(grid[0]):
-            for y in range(grid[1]):
-                _d = distance(pos, (x, y), grid)
-                _rates[x, y] += (f_peak * (np.exp(
-                    (-_d ** 2) / (sigma_stim ** 2 * 2))))
-
-    for x in range(grid[0]):
-        for y in range(grid[1]):
-            _rates[x, y] += f_base
+        _d2 = squared_distance_to_grid(pos, grid)
+        _rates += (f_peak * (np.exp(-_d2 / (sigma_stim ** 2 * 2))))
+
+    _rates += f_base
     return _rates
 
 
@@ -134,22 +110,15 @@ def generate_multimodal_rates(s, grid, f_base=5, f_peak=152.8, sigma_stim=2,
     '''
     _rates = np.zeros(grid)
     for pos in s:
-        for x in range(grid[0]):
-            for y in range(grid[1]):
-                _d = distance(pos, (x, y), grid)
-                _rates[x, y] = f_base + (f_peak * (np.exp(
-                    (-_d * 2) / (sigma_stim ** 2))))
+        _d = distance_to_grid(pos, grid)
+        _rates[:] = f_base + (f_peak * (np.exp((-_d * 2) / (sigma_stim ** 2))))
     return _rates
 
 
 def generate_square_rates(s, grid=np.asarray([16, 16]), f_base=5.,
                           f_peak=152.8, sigma_stim=2., f_mean=20.):
     # f_peak kept for signature compatibility
-    rates = np.empty(grid)
-    for x in range(grid[0]):
-        for y in range(grid[1]):
-            rates[x, y] = 1 if distance((x, y), s, grid=grid) <= float(
-                sigma_stim) else 0
+    rates = (distance_to_grid(s, grid) <= float(sigma_stim)).astype(float)
 
     scalar_ratio = ((f_mean - f_base) * rates.size) / np.count_nonzero(rates)
     rates = rates * scalar_ratio
@@ -192,123 +161,72 @@ def formation_rule(potential_pre, post, sigma, p_form):
 
 def generate_initial_connectivity(s, connections, sigma, p, msg,
                                   N_layer=256, n=16, s_max=16, g_max=.2,
-                                  delay=1.):
-    # print "|", 256 // 4 * "-", "|"
-    # print "|",
-    pbar = ProgressBar(total_number_of_things_to_do=N_layer,
-                       string_describing_what_being_progressed=msg)
-    for postsynaptic_neuron_index in range(N_layer):
-        # if postsynaptic_neuron_index % 8 == 0:
-        #     print "=",
-        pbar.update()
-        post = (postsynaptic_neuron_index // n, postsynaptic_neuron_index % n)
-        while s[postsynaptic_neuron_index] < s_max:
-            potential_pre_index = np.random.randint(0, N_layer)
-            pre = (potential_pre_index // n, potential_pre_index % n)
-            # Commenting this 2 lines to allow for multapses
-
-            # if potential_pre_index not in existing_pre[
-            #     postsynaptic_neuron_index]:
-            if formation_rule(pre, post, sigma, p):
-                s[postsynaptic_neuron_index] += 1
-                connections.append((potential_pre_index,
-                                    postsynaptic_neuron_index, g_max, delay))
-                # print " |"
+                                  delay=1., seed=None, stream=FF_STREAM,
+                                  processes=None):
+    '''
+    Fill every postsynaptic neuron up to s_max synapses (multapses allowed),
+    drawing presynaptic partners with the same distribution as rejection
+    sampling with formation_rule, but vectorized over all neurons. The new
+    synapses are added to connections, a ConnectionList or a list of tuples.
+    msg is kept for compatibility with existing callers.
+
+    Random numbers come from per-block streams derived from seed (a fresh seed
+    is drawn if None) and stream, so the same network is regenerated for any
+    number of processes. Returns the seed used.
+    '''
+    if seed is None:
+        seed = new_seed()
+    grid = np.asarray([N_layer // n, n])
+    counts = np.maximum(s_max - np.asarray(s).astype(np.int64), 0)
+    pre, post = sample_connectivity(counts, sigma, p, grid, seed,
+                                    stream=stream, processes=processes)
+    s[counts > 0] = s_max
+    add_connections(connections, pre, post, g_max, delay)
+    return seed
 
 
 def generate_equivalent_connectivity(s, connections, sigma, p, msg,
                                      N_layer=256, n=16, g_max=.2,
-                                     delay=1.):
-    for postsynaptic_neuron_index in range(N_layer):
-        post = (postsynaptic_neuron_index // n, postsynaptic_neuron_index % n)
-        while s[postsynaptic_neuron_index] > 0:
-            potential_pre_index = np.random.randint(0, N_layer)
-            pre = (potential_pre_index // n, potential_pre_index % n)
-            if formation_rule(pre, post, sigma, p):
-                s[postsynaptic_neuron_index] -= 1
-                connections.append((potential_pre_index,
-                                    postsynaptic_neuron_index, g_max, delay))
+                                     delay=1., seed=None, stream=FF_STREAM,
+                                     processes=None):
+    '''
+    Generate s[j] distance-dependent synapses onto every postsynaptic neuron
+    j, e.g. to build a random network matched to an existing one. The whole
+    network is drawn in one vectorized pass, with the same distribution as
+    one formation_rule trial at a time, using the same per-block random
+    streams as generate_initial_connectivity. Returns the seed used.
+    '''
+    if seed is None:
+        seed = new_seed()
+    grid = np.asarray([N_layer // n, n])
+    pre, post = sample_connectivity(
+        np.asarray(s).astype(np.int64), sigma, p, grid, seed,
+        stream=stream, processes=processes)
+    s[:] = 0
+    add_connections(connections, pre, post, g_max, delay)
+    return seed
 
 
-import os
-import glob
-import bz2
-import pickle
+from mnist_rates import OFF, ON, MnistRateStore, compact_indices
 
 
 def load_mnist_rates(in_path, class_idx, min_noise=0, max_noise=0,
-                     mean_rate=None, suffix=None):
-    from tempfile import mkdtemp
-    import os
-    import glob
-
-    ON, OFF = 0, 1
-    IDX, RATE = 0, 1
-
-    def load_compressed(fname):
-        with bz2.BZ2File(fname, 'rb') as f:
-            obj = pickle.load(f)
-            return obj
-
-    if suffix is not None:
-        fnames = glob.glob(os.path.join(in_path, "*%s.pickle.bz2" % suffix))
-    else:
-        fnames = glob.glob(os.path.join(in_path, "*.pickle.bz2"))
-
-    #     print(fnames)
-    on_rates = None
-    off_rates = None
-    for fname in fnames:
-        spl = os.path.basename(fname).split('__')
-        cls = int(spl[0].split('_')[1])
-        if cls == class_idx:
-            n_smpls = int(spl[1].split('_')[0])
-            width = int(spl[2].split('_')[1])
-            height = int(spl[3].split('_')[1])
-            if mean_rate is not None:
-                new_rate = float(width * height * mean_rate)
-            on_rates, off_rates = None, None
-            data = load_compressed(fname)
-
-            tmp_dir = mkdtemp()
-            np.random.seed()
-            filename = os.path.join(tmp_dir, 'on_rates.dat')
-            on_rates = np.memmap(filename, dtype='uint16', mode='w+',
-                                 shape=(n_smpls, height, width))
-            on_rates[:] = np.round(np.random.uniform(min_noise, max_noise,
-                                                     size=(n_smpls, height,
-                                                           width))).astype(
-                'uint16')
-            for i in xrange(len(data[ON][IDX])):
-                for idx in data[ON][IDX][i]:
-                    r = idx // width
-                    c = idx % width
-                    if mean_rate is None:
-                        on_rates[i, r, c] += data[ON][RATE][i]
-                    else:
-                        on_rates[i, r, c] += round(
-                            new_rate / len(data[ON][IDX][i]))
-            on_rates[on_rates < 0] = 0.
-
-            np.random.seed()
-            filename = os.path.join(tmp_dir, 'off_rates.dat')
-            off_rates = np.memmap(filename, dtype='uint16', mode='w+',
-                                  shape=(n_smpls, height, width))
-            off_rates[:] = np.round(np.random.uniform(min_noise, max_noise,
-                                                      size=(n_smpls, height,
-                                                            width))).astype(
-                'uint16')
-            for i in xrange(len(data[OFF][IDX])):
-                for idx in data[OFF][IDX][i]:
-                    r = idx // width
-                    c = idx % width
-                    if mean_rate is None:
-                        off_rates[i, r, c] += data[OFF][RATE][i]
-                    else:
-                        off_rates[i, r, c] += round(
-                            new_rate / len(data[OFF][IDX][i]))
-
-            off_rates[off_rates < 0] = 0.
-            del data
-
-    return on_rates, off_rates
+                     mean_rate=None, suffix=None, cache_dir=None,
+                     shared=False, seed=None):
+    '''
+    Load the on / off rates of class class_idx from the *.pickle.bz2 files in
+    in_path as (samples, height, width) uint16 arrays. With cache_dir, the
+    decoded rates are stored there the first time and opened as read-only
+    memmaps afterwards. With shared, they are shared in memory with other
+    processes on the host. To load several classes use MnistRateStore, which
+    only scans and decodes once.
+    '''
+    store = MnistRateStore(in_path, min_noise=min_noise,
+                           max_noise=max_noise, mean_rate=mean_rate,
+                           suffix=suffix, classes=[class_idx],
+                           cache_dir=cache_dir, shared=shared, seed=seed)
+    if class_idx not in store:
+        return None, None
+    # The returned memmaps stay valid once the store removes its temporary
+    # files
+    return store[class_idx]
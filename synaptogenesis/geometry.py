@@ -0,0 +1,136 @@
+import numpy as np
+
+# +-------------------------------------------------------------------+
+# | Periodic (torus) geometry                                         |
+# +-------------------------------------------------------------------+
+
+# Distance tables are memoized per (grid shape, metric) so that a process
+# only ever derives them once. Cached arrays are marked read-only.
+_coordinates_cache = {}
+_squared_distance_cache = {}
+_distance_cache = {}
+
+METRICS = ('euclidian', 'manhattan')
+
+
+def _grid_key(grid):
+    return tuple(int(g) for g in np.asarray(grid).ravel())
+
+
+def _check_metric(metric):
+    if metric not in METRICS:
+        raise ValueError("Unknown metric {}. Expected one of {}".format(
+            metric, METRICS))
+
+
+def _read_only(array):
+    array.setflags(write=False)
+    return array
+
+
+def torus_delta(x0, x1, grid=np.asarray([16, 16])):
+    '''
+    Per-axis displacement between x0 and x1 on a grid with periodic
+    boundaries. Coordinates live on the last axis, leading axes broadcast.
+    '''
+    grid = np.asarray(grid)
+    delta = np.abs(np.asarray(x0) - np.asarray(x1))
+    return np.where(np.logical_and(delta > grid * .5, grid > 0),
+                    delta - grid, delta)
+
+
+def distance(x0, x1, grid=np.asarray([16, 16]), type='euclidian'):
+    delta = torus_delta(x0, x1, grid)
+    if type == 'manhattan':
+        return np.abs(delta).sum(axis=-1)
+    return np.sqrt((delta ** 2).sum(axis=-1))
+
+
+def grid_coordinates(grid):
+    '''
+    (N, 2) array of the (row, column) coordinates of every cell in the grid,
+    in the same order as the neuron ids, i.e. id = row * grid[1] + column.
+    '''
+    key = _grid_key(grid)
+    if key not in _coordinates_cache:
+        rows, columns = np.indices(key)
+        _coordinates_cache[key] = _read_only(
+            np.column_stack((rows.ravel(), columns.ravel())))
+    return _coordinates_cache[key]
+
+
+def _axis_deltas(size, offset=None):
+    '''
+    Wrapped absolute displacement along one axis, either between every pair of
+    positions (size x size) or between every position and offset (size,).
+    '''
+    positions = np.arange(size)
+    if offset is None:
+        delta = np.abs(positions[:, None] - positions[None, :])
+    else:
+        delta = np.abs(positions - offset)
+    if size > 0:
+        delta = np.where(delta > size * .5, size - delta, delta)
+    return delta
+
+
+def _combine_axes(delta_x, delta_y, metric):
+    if metric == 'manhattan':
+        return np.add.outer(delta_x, delta_y).astype(float) ** 2
+    return np.add.outer(delta_x ** 2, delta_y ** 2).astype(float)
+
+
+def squared_distance_to_grid(point, grid=np.asarray([16, 16]),
+                             metric='euclidian'):
+    '''
+    Squared torus distance between point and every cell of the grid, returned
+    with the same shape as the grid.
+    '''
+    _check_metric(metric)
+    key = _grid_key(grid)
+    point = np.asarray(point).ravel()
+    return _combine_axes(_axis_deltas(key[0], point[0]),
+                         _axis_deltas(key[1], point[1]), metric)
+
+
+def distance_to_grid(point, grid=np.asarray([16, 16]), metric='euclidian'):
+    '''
+    Torus distance between point and every cell of the grid, returned with the
+    same shape as the grid.
+    '''
+    return np.sqrt(squared_distance_to_grid(point, grid, metric))
+
+
+def squared_distance_table(grid=np.asarray([16, 16]), metric='euclidian'):
+    '''
+    (N, N) table of squared torus distances between every pair of cells in the
+    grid, indexed by neuron id. Computed once per grid shape and metric.
+    '''
+    _check_metric(metric)
+    key = _grid_key(grid) + (metric,)
+    if key not in _squared_distance_cache:
+        g0, g1 = key[0], key[1]
+        table = _combine_axes(_axis_deltas(g0), _axis_deltas(g1), metric)
+        # (x0, x1, y0, y1) -> (x0, y0, x1, y1) -> (id0, id1)
+        table = table.reshape(g0, g0, g1, g1).transpose(0, 2, 1, 3)
+        _squared_distance_cache[key] = _read_only(
+            np.ascontiguousarray(table).reshape(g0 * g1, g0 * g1))
+    return _squared_distance_cache[key]
+
+
+def distance_table(grid=np.asarray([16, 16]), metric='euclidian'):
+    '''
+    (N, N) table of torus distances between every pair of cells in the grid,
+    indexed by neuron id. Computed once per grid shape and metric.
+    '''
+    key = _grid_key(grid) + (metric,)
+    if key not in _distance_cache:
+        _distance_cache[key] = _read_only(
+            np.sqrt(squared_distance_table(grid, metric)))
+    return _distance_cache[key]
+
+
+def clear_distance_cache():
+    _coordinates_cache.clear()
+    _squared_distance_cache.clear()
+    _distance_cache.clear()
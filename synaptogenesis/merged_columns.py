@@ -0,0 +1,106 @@
+import numpy as np
+
+from connectivity import ConnectionList, as_connection_records
+
+# +-------------------------------------------------------------------+
+# | Merged digit columns                                              |
+# +-------------------------------------------------------------------+
+
+# The MNIST networks repeat the same column (a target layer with its own
+# feedforward and lateral connectivity) once per digit. Every column adds
+# populations and projections, and projection count dominates mapping, data
+# generation and extraction time. The columns can instead be laid out side by
+# side in one population per role, column c owning the neurons
+# [offsets[c], offsets[c + 1]), with block-structured connection lists.
+# split_spikes turns the merged spikes back into the per-column arrays the
+# unmerged network would have produced.
+#
+# Only static connectivity can be merged this way: structural plasticity on a
+# merged projection would draw new partners from every column.
+
+
+class ColumnLayout(object):
+    '''
+    no_columns columns of column_size neurons, laid out back to back.
+    '''
+
+    def __init__(self, no_columns, column_size):
+        self.no_columns = no_columns
+        self.column_size = column_size
+        self.offsets = np.arange(no_columns + 1) * column_size
+
+    @property
+    def size(self):
+        return self.offsets[-1]
+
+    def __len__(self):
+        return self.no_columns
+
+    def column_of(self, ids):
+        return np.asarray(ids, dtype=np.int64) // self.column_size
+
+    def to_local(self, ids):
+        return np.asarray(ids, dtype=np.int64) % self.column_size
+
+    def to_global(self, column, ids):
+        return self.offsets[column] + np.asarray(ids, dtype=np.int64)
+
+
+def block_diagonal(blocks, layout, shared_source=False):
+    '''
+    One connection list from the per-column blocks, column c connecting the
+    neurons of column c. With shared_source, the sources are kept as they are
+    and only the targets are moved to their column, for a single source
+    population feeding every column.
+    '''
+    if len(blocks) != len(layout):
+        raise ValueError("Expected {} column blocks, got {}".format(
+            len(layout), len(blocks)))
+    blocks = [as_connection_records(block) for block in blocks]
+    merged = ConnectionList(capacity=sum(len(block) for block in blocks))
+    for column, block in enumerate(blocks):
+        if shared_source:
+            source = block['source']
+        else:
+            source = layout.to_global(column, block['source'])
+        merged.extend_arrays(source, layout.to_global(column, block['target']),
+                             block['weight'], block['delay'])
+    return merged
+
+
+def cross_column_one_to_one(layout, weight, delay):
+    '''
+    Neuron i of every column connected to neuron i of every column, itself
+    included: the merged equivalent of a OneToOneConnector projection between
+    each ordered pair of columns.
+    '''
+    pre, post, neuron = np.meshgrid(np.arange(len(layout)),
+                                    np.arange(len(layout)),
+                                    np.arange(layout.column_size),
+                                    indexing='ij')
+    return ConnectionList.from_arrays(
+        layout.to_global(pre.ravel(), neuron.ravel()),
+        layout.to_global(post.ravel(), neuron.ravel()),
+        weight, delay)
+
+
+def _column_slices(columns, no_columns):
+    # Stable order of the entries by column and where each column starts
+    order = np.argsort(columns, kind='mergesort')
+    bounds = np.concatenate(
+        ([0], np.cumsum(np.bincount(columns, minlength=no_columns))))
+    return order, bounds
+
+
+def split_spikes(spikes, layout):
+    '''
+    (neuron id, time) spikes of a merged population as one array per column,
+    with column-local ids and in their original order.
+    '''
+    spikes = np.asarray(spikes, dtype=float).reshape(-1, 2)
+    columns = layout.column_of(spikes[:, 0])
+    order, bounds = _column_slices(columns, len(layout))
+    spikes = spikes[order]
+    spikes[:, 0] = layout.to_local(spikes[:, 0])
+    return [spikes[start:stop]
+            for start, stop in zip(bounds[:-1], bounds[1:])]
@@ -74,6 +74,11 @@ tau_plus = 20.  # ms
 tau_minus = 20.  # ms
 a_minus = (a_plus * tau_plus * b) / tau_minus
 
+# Connectivity generation
+seed = args.seed if args.seed is not None else new_seed()
+# Noise of the MNIST rates
+mnist_seed = stream_seed(seed, MNIST_NOISE_STREAM)
+
 # Reporting
 
 # Reporting
@@ -106,7 +111,9 @@ sim_params = {'g_max': g_max,
               'a_plus': a_plus,
               'input_type': args.input_type,
               'random_partner': args.random_partner,
-              'lesion': args.lesion
+              'lesion': args.lesion,
+              'seed': seed,
+              'mnist_seed': mnist_seed
               }
 # +-------------------------------------------------------------------+
 # | Initial network setup                                             |
@@ -162,6 +169,8 @@ elif args.case == CASE_REW_NO_CORR:
 # For each source VRPSS load mnist rates from file
 # Use the same initial connectivity for all sets of Populations
 randomised_testing_numbers = None
+randomised_testing_samples = None
+mnist_rates = None
 if not args.testing:
 
     source_column = []
@@ -171,17 +180,18 @@ if not args.testing:
 
 
     if args.case == CASE_CORR_NO_REW:
-        init_ff_connections = [(i, j, g_max, args.delay) for i in
-                               range(N_layer)
-                               for j in range(N_layer) if
-                               np.random.rand() < .1]
-        init_lat_connections = []
+        init_ff_connections = fixed_probability_connections(
+            N_layer, N_layer, .1, g_max, args.delay,
+            rng=block_rng(seed, FF_STREAM, 0))
+        init_lat_connections = ConnectionList()
     else:
-        init_ff_connections = [(i, j, g_max, args.delay) for i in range(N_layer)
-                               for j in range(N_layer) if np.random.rand() < .01]
+        init_ff_connections = fixed_probability_connections(
+            N_layer, N_layer, .01, g_max, args.delay,
+            rng=block_rng(seed, FF_STREAM, 0))
 
-        init_lat_connections = [(i, j, g_max, args.delay) for i in range(N_layer)
-                                for j in range(N_layer) if np.random.rand() < .01]
+        init_lat_connections = fixed_probability_connections(
+            N_layer, N_layer, .01, g_max, args.delay,
+            rng=block_rng(seed, LAT_STREAM, 0))
 
     # number = 0
     # rates_on, rates_off = load_mnist_rates('mnist_input_rates/averaged/',
@@ -204,23 +214,16 @@ if not args.testing:
     randomised_testing_numbers = np.random.randint(0, 10, simtime // t_stim)
 
     # load all rates
-    rates = []
-    for number in range(10):
-        rates_on, rates_off = load_mnist_rates('mnist_input_rates/averaged/',
-                                               number, min_noise=10.,
-                                               max_noise=10.,
-                                               mean_rate=f_mean)
-
-        rates.append(rates_on)
-    testing_rates = np.empty((simtime // t_stim, grid[0], grid[1]))
-    for index in np.arange(randomised_testing_numbers.shape[0]):
-        testing_rates[index, :, :] = \
-            rates[randomised_testing_numbers[index]][np.random.randint(0,
-                                                                       rates[
-                                                                           randomised_testing_numbers[
-                                                                               index]].shape[
-                                                                           0]),
-            :, :]
+    noisier_mnist_rates = MnistRateStore('mnist_input_rates/averaged/',
+                                         min_noise=10., max_noise=10.,
+                                         mean_rate=f_mean,
+                                         cache_dir=args.mnist_cache_dir,
+                                         shared=args.shared_mnist_rates,
+                                         seed=mnist_seed)
+    randomised_testing_samples = noisier_mnist_rates.draw_samples(
+        randomised_testing_numbers)
+    testing_rates = noisier_mnist_rates.gather(randomised_testing_numbers,
+                                               randomised_testing_samples)
     source_pop = sim.Population(N_layer,
                                 sim.SpikeSourcePoissonVariable,
                                 {'rate': testing_rates.reshape(
@@ -231,12 +234,15 @@ if not args.testing:
                                  },
                                 label="VRPSS for testing")
     source_column.append(source_pop)
+    noisier_mnist_rates.close()
 
+    mnist_rates = MnistRateStore('mnist_input_rates/averaged/',
+                                 min_noise=5., max_noise=5., mean_rate=f_mean,
+                                 cache_dir=args.mnist_cache_dir,
+                                 shared=args.shared_mnist_rates,
+                                 seed=mnist_seed)
     for number in range(10):
-        rates_on, rates_off = load_mnist_rates('mnist_input_rates/averaged/',
-                                               number, min_noise=5.,
-                                               max_noise=5.,
-                                               mean_rate=f_mean)
+        rates_on, rates_off = mnist_rates[number]
         # source_column.append(
         #     sim.Population(N_layer,
         #                    sim.SpikeSourcePoissonVariable,
@@ -302,18 +308,15 @@ else:
     randomised_testing_numbers = np.random.randint(0, 10, simtime // t_stim)
 
     # load all rates
-    rates = []
-    for number in range(10):
-        rates_on, rates_off = load_mnist_rates('mnist_input_rates/testing/',
-                                               number, min_noise=5.,
-                                               max_noise=5.,
-                                               mean_rate=f_mean)
-
-        rates.append(rates_on)
-    testing_rates = np.empty((simtime // t_stim, grid[0], grid[1]))
-    for index in np.arange(randomised_testing_numbers.shape[0]):
-        testing_rates[index, :, :] = \
-            rates[randomised_testing_numbers[index]][np.random.randint(0, rates[randomised_testing_numbers[index]].shape[0]), :, :]
+    mnist_rates = MnistRateStore('mnist_input_rates/testing/',
+                                 min_noise=5., max_noise=5., mean_rate=f_mean,
+                                 cache_dir=args.mnist_cache_dir,
+                                 shared=args.shared_mnist_rates,
+                                 seed=mnist_seed)
+    randomised_testing_samples = mnist_rates.draw_samples(
+        randomised_testing_numbers)
+    testing_rates = mnist_rates.gather(randomised_testing_numbers,
+                                       randomised_testing_samples)
     source_pop = sim.Population(N_layer,
                            sim.SpikeSourcePoissonVariable,
                            {'rate': testing_rates.reshape(simtime // t_stim, N_layer),
@@ -362,6 +365,22 @@ post_spikes = []
 pre_weights = []
 post_weights = []
 
+snapshot_store = None
+if args.snapshot_dir and not args.testing:
+    snapshot_names = ["ff_{}".format(i) for i in range(len(ff_connections))]
+    if args.case != CASE_CORR_NO_REW:
+        snapshot_names += ["lat_{}".format(i)
+                           for i in range(len(lat_connections))]
+    snapshot_store = SnapshotStore(args.snapshot_dir, names=snapshot_names,
+                                   keep_recent=args.snapshot_keep_recent,
+                                   thin_stride=args.snapshot_thin_stride,
+                                   mode='w',
+                                   overwrite=args.snapshot_overwrite)
+snapshot_buffer = SnapshotBuffer()
+snapshot_projections = list(ff_connections)
+if args.case != CASE_CORR_NO_REW:
+    snapshot_projections += lat_connections
+
 no_runs = simtime // t_record
 run_duration = t_record
 
@@ -371,21 +390,16 @@ for current_run in range(no_runs):
 
     # Retrieve data if training
     if not args.testing:
-        for ff_projection in ff_connections:
-            pre_weights.append(
-                np.array([
-                    ff_projection._get_synaptic_data(True, 'source'),
-                    ff_projection._get_synaptic_data(True, 'target'),
-                    ff_projection._get_synaptic_data(True, 'weight'),
-                    ff_projection._get_synaptic_data(True, 'delay')]).T)
-        if args.case != CASE_CORR_NO_REW:
-            for lat_projection in lat_connections:
-                post_weights.append(
-                    np.array([
-                        lat_projection._get_synaptic_data(True, 'source'),
-                        lat_projection._get_synaptic_data(True, 'target'),
-                        lat_projection._get_synaptic_data(True, 'weight'),
-                        lat_projection._get_synaptic_data(True, 'delay')]).T)
+        snapshot = snapshot_buffer.extract(snapshot_projections)
+        if snapshot_store is not None:
+            snapshot_store.append((current_run + 1) * run_duration,
+                                  snapshot)
+            # Only the latest snapshot stays in memory, as views of the buffer
+            del pre_weights[:], post_weights[:]
+        else:
+            snapshot = snapshot_buffer.copies()
+        pre_weights.extend(snapshot[:len(ff_connections)])
+        post_weights.extend(snapshot[len(ff_connections):])
 
 if args.record_source:
     for source_pop in source_column:
@@ -395,6 +409,9 @@ for target_pop in target_column:
 # End simulation on SpiNNaker
 sim.end()
 
+if mnist_rates is not None:
+    mnist_rates.close()
+
 end_time = plt.datetime.datetime.now()
 total_time = end_time - start_time
 
@@ -416,10 +433,13 @@ np.savez(filename,
          lat_connections=post_weights,
          final_pre_weights=pre_weights[-10:],
          final_post_weights=post_weights[-10:],
+         snapshot_dir=(snapshot_store.directory
+                       if snapshot_store is not None else None),
          simtime=simtime,
          sim_params=sim_params,
          total_time=total_time,
-         testing_numbers=randomised_testing_numbers,
+         testing_numbers=compact_indices(randomised_testing_numbers),
+         testing_samples=compact_indices(randomised_testing_samples),
          testing_file=args.testing,
          exception=None)
 
@@ -0,0 +1,506 @@
+import bz2
+import glob
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager
+from tempfile import gettempdir, mkdtemp
+
+import numpy as np
+
+from fileutils import atomic_write, makedirs
+
+# +-------------------------------------------------------------------+
+# | Decoded MNIST rate cache                                          |
+# +-------------------------------------------------------------------+
+
+# Decoding a *.pickle.bz2 rate file and rasterising it takes far longer than
+# the simulation set-up it feeds. The decoded uint16 on / off rates of each
+# (source file, class, noise, mean rate, suffix) combination are kept in a
+# cache directory as .npy files, described by a JSON manifest, and opened as
+# read-only memmaps by later runs.
+#
+# Noise is drawn once, when an entry is created. With min_noise == max_noise,
+# as in the MNIST scripts, the noise is a constant offset and entries are
+# shared by every seed; otherwise the seed is part of the key.
+#
+# The same layout in a tmpfs directory (SHARED_DIR, /dev/shm where available)
+# lets concurrent simulations on one host share a single copy of each decoded
+# dataset: the first process to need an entry decodes and publishes it while
+# holding a lock on it, the others wait and then map it read-only.
+
+CACHE_VERSION = 1
+MANIFEST = 'manifest.json'
+
+SHARED_DIR = os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else gettempdir(),
+    'synaptogenesis_mnist_rates')
+
+
+def load_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, MANIFEST), 'r') as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        manifest = {}
+    manifest.setdefault('version', CACHE_VERSION)
+    manifest.setdefault('sources', {})
+    manifest.setdefault('entries', {})
+    return manifest
+
+
+# Without fcntl (e.g. on Windows) locks only hold between the threads of one
+# process
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+@contextmanager
+def locked(cache_dir, name, remove=False):
+    '''
+    Exclusive lock, across threads and processes, on name in cache_dir. With
+    remove, the lock file is deleted before the lock is released. Only do so
+    when whatever the lock guards is complete by then: a waiter may be left
+    holding a lock on the deleted file while a newcomer locks a new one, so
+    both must find the work done and skip it.
+    '''
+    makedirs(cache_dir)
+    try:
+        import fcntl
+    except ImportError:
+        path = os.path.join(os.path.abspath(cache_dir), name)
+        with _thread_locks_lock:
+            lock = _thread_locks.setdefault(path, threading.Lock())
+        with lock:
+            try:
+                yield
+            finally:
+                if remove:
+                    with _thread_locks_lock:
+                        _thread_locks.pop(path, None)
+        return
+    lock_filename = os.path.join(cache_dir, name + '.lock')
+    with open(lock_filename, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if remove:
+                try:
+                    os.remove(lock_filename)
+                except OSError:
+                    pass
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def save_manifest(cache_dir, manifest):
+    '''
+    Merge manifest into the one on disk, so that runs sharing cache_dir do
+    not drop each other's entries.
+    '''
+    with locked(cache_dir, MANIFEST):
+        merged = load_manifest(cache_dir)
+        merged['sources'].update(manifest['sources'])
+        merged['entries'].update(manifest['entries'])
+        atomic_write(os.path.join(cache_dir, MANIFEST),
+                     lambda f: f.write(json.dumps(merged, indent=1,
+                                                  sort_keys=True)))
+
+
+def file_digest(fname, block_size=2 ** 20):
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_digest(fname, manifest):
+    '''
+    Content hash of a source file. Hashes are remembered in the manifest by
+    path, size and modification time, so unchanged files are not re-read.
+    '''
+    stat = os.stat(fname)
+    path = os.path.abspath(fname)
+    known = manifest['sources'].get(path)
+    if known is not None and known['size'] == stat.st_size and \
+            known['mtime'] == stat.st_mtime:
+        return known['sha1']
+    sha1 = file_digest(fname)
+    manifest['sources'][path] = {'size': stat.st_size,
+                                 'mtime': stat.st_mtime,
+                                 'sha1': sha1}
+    return sha1
+
+
+def rates_cache_key(digest, class_idx, min_noise=0, max_noise=0,
+                    mean_rate=None, suffix=None, seed=None):
+    description = rates_description(digest, class_idx, min_noise, max_noise,
+                                    mean_rate, suffix, seed)
+    return hashlib.sha1(
+        json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def rates_description(digest, class_idx, min_noise=0, max_noise=0,
+                      mean_rate=None, suffix=None, seed=None):
+    description = {'version': CACHE_VERSION,
+                   'source_sha1': digest,
+                   'class_idx': int(class_idx),
+                   'min_noise': float(min_noise),
+                   'max_noise': float(max_noise),
+                   'mean_rate': None if mean_rate is None
+                   else float(mean_rate),
+                   'suffix': suffix}
+    if min_noise != max_noise:
+        # Random noise depends on the seed of the store that drew it
+        description['seed'] = None if seed is None else int(seed)
+    return description
+
+
+def _entry_filenames(cache_dir, key):
+    return (os.path.join(cache_dir, key + '_on.npy'),
+            os.path.join(cache_dir, key + '_off.npy'))
+
+
+def load_cached_rates(cache_dir, key):
+    '''
+    Read-only (on_rates, off_rates) memmaps of a cache entry, or None if the
+    entry does not exist.
+    '''
+    on_filename, off_filename = _entry_filenames(cache_dir, key)
+    if not (os.path.exists(on_filename) and os.path.exists(off_filename)):
+        return None
+    return (np.load(on_filename, mmap_mode='r'),
+            np.load(off_filename, mmap_mode='r'))
+
+
+def store_cached_rates(cache_dir, key, on_rates, off_rates,
+                       description=None, manifest=None):
+    '''
+    Add decoded rates to the cache and return them as read-only memmaps. The
+    entry is recorded in manifest if one is given, to be saved by the caller,
+    otherwise straight into the manifest on disk.
+    '''
+    makedirs(cache_dir)
+    for filename, rates in zip(_entry_filenames(cache_dir, key),
+                               (on_rates, off_rates)):
+        atomic_write(filename,
+                     lambda f: np.save(f, np.asarray(rates, dtype='uint16')))
+    if manifest is None:
+        save_manifest(cache_dir, {'sources': {},
+                                  'entries': {key: description}})
+    else:
+        manifest['entries'][key] = description
+    return load_cached_rates(cache_dir, key)
+
+
+def clear_shared_rates(shared_dir=SHARED_DIR):
+    '''
+    Release the memory held by rates published in shared_dir.
+    '''
+    shutil.rmtree(shared_dir, ignore_errors=True)
+
+
+# +-------------------------------------------------------------------+
+# | Rasterisation                                                     |
+# +-------------------------------------------------------------------+
+
+
+def _round_half_away(values):
+    # Builtin round, used by the original per-pixel loop, rounds half away
+    # from zero rather than to even
+    return np.floor(values + .5)
+
+
+def rasterise_rates(indices, rates, shape, mean_rate=None):
+    '''
+    Integer rate increments, shaped (samples, height, width), for the active
+    pixel indices of every sample, all samples at once. Each active pixel of
+    sample i gets rates[i] or, with mean_rate, an equal share of
+    width * height * mean_rate, rounded.
+
+    Adding the result to uint16 noise gives exactly what adding one pixel at
+    a time to the uint16 array gave, since that truncated every addition.
+    '''
+    n_smpls, height, width = shape
+    lengths = np.asarray([len(sample) for sample in indices], dtype=np.int64)
+    increments = np.zeros(int(np.prod(shape)), dtype=np.int64)
+    if lengths.sum() == 0:
+        return increments.reshape(shape)
+    samples = np.repeat(np.arange(lengths.size), lengths)
+    pixels = np.concatenate([np.asarray(sample, dtype=np.int64).ravel()
+                             for sample in indices if len(sample)])
+    if mean_rate is None:
+        per_sample = np.trunc(np.asarray(rates, dtype=float)[:lengths.size])
+    else:
+        new_rate = float(width * height * mean_rate)
+        per_sample = _round_half_away(new_rate / np.maximum(lengths, 1))
+    flat = samples * (height * width) + pixels
+    increments += np.bincount(flat, weights=per_sample[samples],
+                              minlength=increments.size).astype(np.int64)
+    return increments.reshape(shape)
+
+
+# +-------------------------------------------------------------------+
+# | Rate files                                                        |
+# +-------------------------------------------------------------------+
+
+ON, OFF = 0, 1
+IDX, RATE = 0, 1
+
+MAX_SEED = 2 ** 31 - 1
+
+
+def parse_rates_filename(fname):
+    '''
+    (class, samples, width, height) from a file name such as
+    cls_3__6000_samples__width_28__height_28__CS.pickle.bz2
+    '''
+    spl = os.path.basename(fname).split('__')
+    return (int(spl[0].split('_')[1]), int(spl[1].split('_')[0]),
+            int(spl[2].split('_')[1]), int(spl[3].split('_')[1]))
+
+
+def find_rates_files(in_path, suffix=None):
+    '''
+    Map every class to its rate file in in_path. If several files hold the
+    same class, the last one listed wins.
+    '''
+    if suffix is not None:
+        fnames = glob.glob(os.path.join(in_path, "*%s.pickle.bz2" % suffix))
+    else:
+        fnames = glob.glob(os.path.join(in_path, "*.pickle.bz2"))
+    files = {}
+    for fname in fnames:
+        files[parse_rates_filename(fname)[0]] = fname
+    return files
+
+
+def compact_indices(indices):
+    '''
+    Non-negative integer indices (e.g. labels) in the smallest unsigned type
+    that holds them, for storing in result archives.
+    '''
+    if indices is None:
+        return None
+    indices = np.asarray(indices)
+    return indices.astype(np.min_scalar_type(
+        int(indices.max()) if indices.size else 0))
+
+
+def load_compressed(fname):
+    with bz2.BZ2File(fname, 'rb') as f:
+        return pickle.load(f)
+
+
+class MnistRateStore(object):
+    '''
+    On / off rates of every class in a directory of *.pickle.bz2 rate files,
+    as (samples, height, width) uint16 arrays. The directory is scanned once
+    and all classes are decoded in one pass, by a pool of threads (bz2
+    decompression releases the GIL).
+
+    The noise of class c and polarity p comes from its own random stream
+    seeded with (seed, c, p), so it does not depend on which classes are
+    loaded or in which order. Decoded rates live in memmaps in a temporary
+    directory owned by the store, removed by close(), unless they come from
+    cache_dir or, with shared=True, from shared_dir (see load_cached_rates),
+    in which case they are read-only memmaps of the cache entries.
+    '''
+
+    def __init__(self, in_path, min_noise=0, max_noise=0, mean_rate=None,
+                 suffix=None, classes=None, cache_dir=None, shared=False,
+                 shared_dir=SHARED_DIR, seed=None, threads=None):
+        self.in_path = in_path
+        self.min_noise = min_noise
+        self.max_noise = max_noise
+        self.mean_rate = mean_rate
+        self.suffix = suffix
+        self.cache_dir = cache_dir
+        self.shared_dir = shared_dir if shared else None
+        self.seed = int(np.random.randint(0, MAX_SEED)) if seed is None \
+            else int(seed)
+        self.files = find_rates_files(in_path, suffix)
+        if classes is None:
+            classes = sorted(self.files)
+        classes = [cls for cls in classes if cls in self.files]
+
+        self._tmp_dir = None
+        self._rates = {}
+        self._lock = threading.Lock()
+        # Shared memory first, then the disk cache
+        self._cache_dirs = [directory for directory in
+                            (self.shared_dir, self.cache_dir)
+                            if directory is not None]
+        self._manifests = dict((directory, load_manifest(directory))
+                               for directory in self._cache_dirs)
+
+        if threads is None:
+            threads = min(len(classes), cpu_count())
+        if threads > 1:
+            pool = ThreadPool(threads)
+            try:
+                pool.map(self._load_class, classes)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for cls in classes:
+                self._load_class(cls)
+        for directory, manifest in self._manifests.items():
+            save_manifest(directory, manifest)
+
+    @property
+    def classes(self):
+        return sorted(self._rates)
+
+    def __len__(self):
+        return len(self._rates)
+
+    def __contains__(self, class_idx):
+        return class_idx in self._rates
+
+    def __getitem__(self, class_idx):
+        '''
+        (on_rates, off_rates) of one class.
+        '''
+        return self._rates[class_idx]
+
+    def on(self, class_idx):
+        return self._rates[class_idx][ON]
+
+    def off(self, class_idx):
+        return self._rates[class_idx][OFF]
+
+    def sample_counts(self):
+        '''
+        Number of samples of every class, indexed by class.
+        '''
+        counts = np.zeros(max(self._rates) + 1 if self._rates else 0,
+                          dtype=np.int64)
+        for class_idx, rates in self._rates.items():
+            counts[class_idx] = rates[ON].shape[0]
+        return counts
+
+    def draw_samples(self, labels, rng=None):
+        '''
+        A uniformly random sample index within its class for every label.
+        '''
+        rng = np.random if rng is None else rng
+        counts = self.sample_counts()[np.asarray(labels)]
+        samples = (rng.uniform(size=counts.shape) * counts).astype(np.int64)
+        return np.minimum(samples, counts - 1)
+
+    def gather(self, labels, samples, polarity=ON, dtype=float):
+        '''
+        (frames, height, width) rates of sample samples[i] of class labels[i]
+        for every frame i. Frames are read straight from the per-class maps,
+        one gather per class, so only the selected frames are copied.
+        '''
+        labels = np.asarray(labels)
+        samples = np.asarray(samples)
+        shape = self._rates[self.classes[0]][polarity].shape[1:]
+        frames = np.empty(labels.shape + shape, dtype=dtype)
+        for class_idx in np.unique(labels):
+            selected = labels == class_idx
+            frames[selected] = \
+                self._rates[class_idx][polarity][samples[selected]]
+        return frames
+
+    def _noise(self, class_idx, polarity, shape):
+        rng = np.random.RandomState([self.seed, int(class_idx), polarity])
+        return np.round(rng.uniform(self.min_noise, self.max_noise,
+                                    size=shape)).astype('uint16')
+
+    def _allocate(self, name, shape, temporary):
+        if not temporary:
+            return np.empty(shape, dtype='uint16')
+        with self._lock:
+            if self._tmp_dir is None:
+                self._tmp_dir = mkdtemp()
+        return np.memmap(os.path.join(self._tmp_dir, name), dtype='uint16',
+                         mode='w+', shape=shape)
+
+    def _decode(self, class_idx, temporary=True):
+        fname = self.files[class_idx]
+        _, n_smpls, width, height = parse_rates_filename(fname)
+        shape = (n_smpls, height, width)
+        data = load_compressed(fname)
+        rates = []
+        for polarity in (ON, OFF):
+            polarity_rates = self._allocate(
+                "{}_{}.dat".format(class_idx, polarity), shape, temporary)
+            polarity_rates[:] = self._noise(class_idx, polarity, shape)
+            polarity_rates += rasterise_rates(
+                data[polarity][IDX], data[polarity][RATE], shape,
+                self.mean_rate).astype('uint16')
+            rates.append(polarity_rates)
+        return tuple(rates)
+
+    def _store(self, directory, key, rates, description):
+        with self._lock:
+            manifest = self._manifests[directory]
+        return store_cached_rates(directory, key, rates[ON], rates[OFF],
+                                  description=description, manifest=manifest)
+
+    def _cached(self, key, description):
+        for index, directory in enumerate(self._cache_dirs):
+            rates = load_cached_rates(directory, key)
+            if rates is not None:
+                # e.g. on disk but not yet published in shared memory
+                for missing in self._cache_dirs[:index]:
+                    rates = self._store(missing, key, rates, description)
+                return rates
+        return None
+
+    def _load_class(self, class_idx):
+        if not self._cache_dirs:
+            self._rates[class_idx] = self._decode(class_idx)
+            return
+
+        with self._lock:
+            digest = source_digest(self.files[class_idx],
+                                   self._manifests[self._cache_dirs[-1]])
+        description = rates_description(digest, class_idx, self.min_noise,
+                                        self.max_noise, self.mean_rate,
+                                        self.suffix, self.seed)
+        key = rates_cache_key(digest, class_idx, self.min_noise,
+                              self.max_noise, self.mean_rate, self.suffix,
+                              self.seed)
+        rates = self._cached(key, description)
+        if rates is None:
+            # Only one thread or process decodes a given entry, the others
+            # wait for it and map the result. The entry is published before
+            # its lock file is removed
+            with locked(self._cache_dirs[0], key, remove=True):
+                rates = self._cached(key, description)
+                if rates is None:
+                    rates = self._decode(class_idx, temporary=False)
+                    for directory in reversed(self._cache_dirs):
+                        rates = self._store(directory, key, rates,
+                                            description)
+        self._rates[class_idx] = rates
+
+    def close(self):
+        '''
+        Drop the rates and remove the temporary directory, if any.
+        '''
+        self._rates = {}
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, '_tmp_dir', None) is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
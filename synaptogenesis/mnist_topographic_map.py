@@ -74,6 +74,11 @@ tau_plus = 20.  # ms
 tau_minus = 20.  # ms
 a_minus = (a_plus * tau_plus * b) / tau_minus
 
+# Connectivity generation
+seed = args.seed if args.seed is not None else new_seed()
+# Noise of the MNIST rates
+mnist_seed = stream_seed(seed, MNIST_NOISE_STREAM)
+
 # Reporting
 
 sim_params = {'g_max': g_max,
@@ -105,7 +110,10 @@ sim_params = {'g_max': g_max,
               'a_plus': a_plus,
               'input_type': args.input_type,
               'random_partner': args.random_partner,
-              'lesion': args.lesion
+              'lesion': args.lesion,
+              'merged_columns': args.merged_columns,
+              'seed': seed,
+              'mnist_seed': mnist_seed
               }
 # +-------------------------------------------------------------------+
 # | Initial network setup                                             |
@@ -153,6 +161,9 @@ elif args.case == CASE_REW_NO_CORR or args.case == CASE_CORR_NO_REW:
 # For each source VRPSS load mnist rates from file
 # Use the same initial connectivity for all sets of Populations
 randomised_testing_numbers = None
+randomised_testing_samples = None
+columns = None
+mnist_rates = None
 if not args.testing:
 
     source_column_on = []
@@ -163,28 +174,27 @@ if not args.testing:
     lat_connections = []
 
     if args.case == CASE_CORR_NO_REW:
-        init_ff_on_connections = [(i, j, g_max, args.delay) for i in
-                                  range(N_layer)
-                                  for j in range(N_layer) if
-                                  np.random.rand() < .1]
-        init_lat_connections = []
+        init_ff_on_connections = fixed_probability_connections(
+            N_layer, N_layer, .1, g_max, args.delay,
+            rng=block_rng(seed, FF_STREAM, 0))
+        init_lat_connections = ConnectionList()
     else:
-        init_ff_on_connections = [(i, j, g_max, args.delay) for i in
-                                  range(N_layer)
-                                  for j in range(N_layer) if
-                                  np.random.rand() < .01]
-
-        init_lat_connections = [(i, j, g_max, args.delay) for i in
-                                range(N_layer)
-                                for j in range(N_layer) if
-                                np.random.rand() < .01]
+        init_ff_on_connections = fixed_probability_connections(
+            N_layer, N_layer, .01, g_max, args.delay,
+            rng=block_rng(seed, FF_STREAM, 0))
+
+        init_lat_connections = fixed_probability_connections(
+            N_layer, N_layer, .01, g_max, args.delay,
+            rng=block_rng(seed, LAT_STREAM, 0))
     init_ff_off_connections = init_ff_on_connections
+    mnist_rates = MnistRateStore(
+        'mnist_input_rates/centre_surround/', min_noise=f_mean / 4.,
+        max_noise=f_mean / 4., mean_rate=f_mean, suffix="CS",
+        cache_dir=args.mnist_cache_dir,
+        shared=args.shared_mnist_rates,
+        seed=mnist_seed)
     for number in range(10):
-        rates_on, rates_off = load_mnist_rates(
-            'mnist_input_rates/centre_surround/',
-            number, min_noise=f_mean / 4.,
-            max_noise=f_mean / 4.,
-            mean_rate=f_mean, suffix="CS")
+        rates_on, rates_off = mnist_rates[number]
         source_column_on.append(
             sim.Population(N_layer,
                            sim.SpikeSourcePoissonVariable,
@@ -276,32 +286,18 @@ else:
                                                        simtime // t_stim)
 
         # load all rates
-        rates_on = []
-        rates_off = []
-        for number in range(10):
-            rate_on, rate_off = load_mnist_rates(
-                'mnist_input_rates/testing_centre_surround/',
-                number, min_noise=f_mean / 4.,
-                max_noise=f_mean / 4.,
-                mean_rate=f_mean, suffix="CS")
-
-            rates_on.append(rate_on)
-            rates_off.append(rate_off)
-    testing_rates_on = np.empty((simtime // t_stim, grid[0], grid[1]))
-    testing_rates_off = np.empty((simtime // t_stim, grid[0], grid[1]))
-    for index in np.arange(testing_rates_on.shape[0]):
-        if not args.random_input:
-            random_number = np.random.randint(0, rates_on[
-                randomised_testing_numbers[
-                    index]].shape[0])
-            testing_rates_on[index, :, :] = \
-                rates_on[
-                    randomised_testing_numbers[index]][random_number, :, :]
-            testing_rates_off[index, :, :] = \
-                rates_off[
-                    randomised_testing_numbers[index]][random_number, :, :]
-        else:
-            break
+        mnist_rates = MnistRateStore(
+            'mnist_input_rates/testing_centre_surround/',
+            min_noise=f_mean / 4., max_noise=f_mean / 4., mean_rate=f_mean,
+            suffix="CS", cache_dir=args.mnist_cache_dir,
+            shared=args.shared_mnist_rates,
+            seed=mnist_seed)
+        randomised_testing_samples = mnist_rates.draw_samples(
+            randomised_testing_numbers)
+        testing_rates_on = mnist_rates.gather(
+            randomised_testing_numbers, randomised_testing_samples, ON)
+        testing_rates_off = mnist_rates.gather(
+            randomised_testing_numbers, randomised_testing_samples, OFF)
     if not args.random_input:
         source_on_pop = sim.Population(
             N_layer,
@@ -343,39 +339,77 @@ else:
 
     source_column_on.append(source_on_pop)
     source_column_off.append(source_off_pop)
-    for number in range(10):
-        # Neuron populations
-        target_column.append(
-            sim.Population(N_layer, model, cell_params,
-                           label="TARGET_POP # " + str(number))
-        )
+    if args.merged_columns:
+        # One population and one projection per role instead of one per digit
+        columns = ColumnLayout(10, N_layer)
+        target_pop = sim.Population(columns.size, model, cell_params,
+                                    label="TARGET_POP merged")
+        target_column.append(target_pop)
 
         ff_on_connections.append(
             sim.Projection(
-                source_on_pop, target_column[number],
-                sim.FromListConnector(trained_ff_on_connectivity[number]),
-                label="ff_projection on " + str(number)
+                source_on_pop, target_pop,
+                sim.FromListConnector(block_diagonal(
+                    trained_ff_on_connectivity, columns,
+                    shared_source=True)),
+                label="ff_projection on merged"
             )
         )
 
         ff_off_connections.append(
             sim.Projection(
-                source_off_pop, target_column[number],
-                sim.FromListConnector(trained_ff_off_connectivity[number]),
-                label="ff_projection off " + str(number)
+                source_off_pop, target_pop,
+                sim.FromListConnector(block_diagonal(
+                    trained_ff_off_connectivity, columns,
+                    shared_source=True)),
+                label="ff_projection off merged"
             )
         )
         if args.case != CASE_CORR_NO_REW:
             lat_connections.append(
                 sim.Projection(
-                    target_column[number], target_column[number],
-                    sim.FromListConnector(
-                        trained_lat_connectivity[number]),
-                    label="lat_projection " + str(number),
+                    target_pop, target_pop,
+                    sim.FromListConnector(block_diagonal(
+                        trained_lat_connectivity, columns)),
+                    label="lat_projection merged",
                     target="inhibitory" if args.lateral_inhibition
                     else "excitatory"
                 )
             )
+    else:
+        for number in range(10):
+            # Neuron populations
+            target_column.append(
+                sim.Population(N_layer, model, cell_params,
+                               label="TARGET_POP # " + str(number))
+            )
+
+            ff_on_connections.append(
+                sim.Projection(
+                    source_on_pop, target_column[number],
+                    sim.FromListConnector(trained_ff_on_connectivity[number]),
+                    label="ff_projection on " + str(number)
+                )
+            )
+
+            ff_off_connections.append(
+                sim.Projection(
+                    source_off_pop, target_column[number],
+                    sim.FromListConnector(trained_ff_off_connectivity[number]),
+                    label="ff_projection off " + str(number)
+                )
+            )
+            if args.case != CASE_CORR_NO_REW:
+                lat_connections.append(
+                    sim.Projection(
+                        target_column[number], target_column[number],
+                        sim.FromListConnector(
+                            trained_lat_connectivity[number]),
+                        label="lat_projection " + str(number),
+                        target="inhibitory" if args.lateral_inhibition
+                        else "excitatory"
+                    )
+                )
 
 if args.record_source:
     for source_on_pop in source_column_on:
@@ -394,6 +428,27 @@ pre_on_weights = []
 pre_off_weights = []
 post_weights = []
 
+snapshot_store = None
+if args.snapshot_dir and not args.testing:
+    snapshot_names = ["ff_on_{}".format(i)
+                      for i in range(len(ff_on_connections))]
+    snapshot_names += ["ff_off_{}".format(i)
+                       for i in range(len(ff_off_connections))]
+    if args.case != CASE_CORR_NO_REW:
+        snapshot_names += ["lat_{}".format(i)
+                           for i in range(len(lat_connections))]
+    snapshot_store = SnapshotStore(args.snapshot_dir, names=snapshot_names,
+                                   keep_recent=args.snapshot_keep_recent,
+                                   thin_stride=args.snapshot_thin_stride,
+                                   mode='w',
+                                   overwrite=args.snapshot_overwrite)
+snapshot_buffer = SnapshotBuffer()
+snapshot_projections = ff_on_connections + ff_off_connections
+if args.case != CASE_CORR_NO_REW:
+    snapshot_projections += lat_connections
+no_ff_on = len(ff_on_connections)
+no_ff = no_ff_on + len(ff_off_connections)
+
 no_runs = simtime // t_record
 run_duration = t_record
 
@@ -403,28 +458,17 @@ for current_run in range(no_runs):
 
     # Retrieve data if training
     if not args.testing:
-        for ff_projection in ff_on_connections:
-            pre_on_weights.append(
-                np.array([
-                    ff_projection._get_synaptic_data(True, 'source'),
-                    ff_projection._get_synaptic_data(True, 'target'),
-                    ff_projection._get_synaptic_data(True, 'weight'),
-                    ff_projection._get_synaptic_data(True, 'delay')]).T)
-        for ff_projection in ff_off_connections:
-            pre_off_weights.append(
-                np.array([
-                    ff_projection._get_synaptic_data(True, 'source'),
-                    ff_projection._get_synaptic_data(True, 'target'),
-                    ff_projection._get_synaptic_data(True, 'weight'),
-                    ff_projection._get_synaptic_data(True, 'delay')]).T)
-        if args.case != CASE_CORR_NO_REW:
-            for lat_projection in lat_connections:
-                post_weights.append(
-                    np.array([
-                        lat_projection._get_synaptic_data(True, 'source'),
-                        lat_projection._get_synaptic_data(True, 'target'),
-                        lat_projection._get_synaptic_data(True, 'weight'),
-                        lat_projection._get_synaptic_data(True, 'delay')]).T)
+        snapshot = snapshot_buffer.extract(snapshot_projections)
+        if snapshot_store is not None:
+            snapshot_store.append((current_run + 1) * run_duration,
+                                  snapshot)
+            # Only the latest snapshot stays in memory, as views of the buffer
+            del pre_on_weights[:], pre_off_weights[:], post_weights[:]
+        else:
+            snapshot = snapshot_buffer.copies()
+        pre_on_weights.extend(snapshot[:no_ff_on])
+        pre_off_weights.extend(snapshot[no_ff_on:no_ff])
+        post_weights.extend(snapshot[no_ff:])
 
 if args.record_source:
     for source_on_pop in source_column_on:
@@ -433,9 +477,15 @@ if args.record_source:
         pre_off_spikes.append(source_on_pop.getSpikes(compatible_output=True))
 for target_pop in target_column:
     post_spikes.append(target_pop.getSpikes(compatible_output=True))
+if columns is not None:
+    # Per-digit spikes, as recorded by the unmerged network
+    post_spikes = split_spikes(post_spikes[0], columns)
 # End simulation on SpiNNaker
 sim.end()
 
+if mnist_rates is not None:
+    mnist_rates.close()
+
 end_time = plt.datetime.datetime.now()
 total_time = end_time - start_time
 
@@ -461,10 +511,13 @@ np.savez(filename,
          final_pre_on_weights=pre_on_weights[-10:],
          final_pre_off_weights=pre_off_weights[-10:],
          final_post_weights=post_weights[-10:],
+         snapshot_dir=(snapshot_store.directory
+                       if snapshot_store is not None else None),
          simtime=simtime,
          sim_params=sim_params,
          total_time=total_time,
-         testing_numbers=randomised_testing_numbers,
+         testing_numbers=compact_indices(randomised_testing_numbers),
+         testing_samples=compact_indices(randomised_testing_samples),
          testing_file=args.testing, random_input=args.random_input,
          exception=None)
 
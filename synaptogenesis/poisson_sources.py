@@ -0,0 +1,136 @@
+import numpy as np
+
+# +-------------------------------------------------------------------+
+# | Population-wide Poisson spike trains                              |
+# +-------------------------------------------------------------------+
+
+# Spike trains for a whole population are kept in CSR layout: a flat array of
+# spike times, sorted by neuron and then by time, plus an (N + 1,) array of
+# offsets such that the spikes of neuron i are times[offsets[i]:offsets[i+1]]
+
+
+def _rng(rng):
+    return np.random if rng is None else rng
+
+
+def _round_ms(times):
+    # Round half away from zero, like the builtin round used by
+    # poisson_generator, rather than numpy's round half to even
+    return np.floor(times + .5)
+
+
+def _compress(neuron_ids, times, N, t_stop):
+    '''
+    Round spike times to millisecond boundaries, sort them per neuron, drop
+    duplicates and anything at or after t_stop, then build the CSR layout.
+    '''
+    times = _round_ms(times)
+    valid = times < t_stop
+    neuron_ids = neuron_ids[valid]
+    times = times[valid]
+    # Sort on a single integer key (neuron, millisecond), which is much
+    # cheaper than a lexsort and makes duplicates adjacent
+    base = np.floor(np.min(times)) if times.size else 0.
+    span = int(np.ceil(t_stop - base)) + 1
+    keys = neuron_ids.astype(np.int64) * span + \
+           (times - base).astype(np.int64)
+    keys.sort()
+    keep = np.ones(keys.size, dtype=bool)
+    keep[1:] = keys[1:] != keys[:-1]
+    keys = keys[keep]
+    neuron_ids = keys // span
+    times = (keys % span) + base
+    offsets = np.zeros(N + 1, dtype=np.int64)
+    np.cumsum(np.bincount(neuron_ids, minlength=N), out=offsets[1:])
+    return times, offsets
+
+
+def poisson_population(rates, t_start, t_stop, rng=None):
+    '''
+    Generate homogeneous Poisson spike trains for a whole population at once.
+    rates (Hz) holds one rate per neuron. Spike times are rounded to
+    millisecond boundaries and unique per neuron, as with poisson_generator.
+
+    Returns (times, offsets) in CSR layout.
+    '''
+    rng = _rng(rng)
+    rates = np.asarray(rates, dtype=float).ravel()
+    N = rates.size
+    duration = float(t_stop - t_start)
+    if duration <= 0:
+        return np.zeros(0), np.zeros(N + 1, dtype=np.int64)
+    # Conditioned on the spike count, the spike times of a homogeneous
+    # Poisson process are independent and uniform over the interval
+    counts = rng.poisson(np.maximum(rates, 0.) * duration / 1000.)
+    neuron_ids = np.repeat(np.arange(N), counts)
+    times = t_start + rng.uniform(0., duration, size=neuron_ids.size)
+    return _compress(neuron_ids, times, N, t_stop)
+
+
+def spike_train(times, offsets, neuron_id):
+    '''
+    Spike times of a single neuron, as a view into the CSR arrays.
+    '''
+    return times[offsets[neuron_id]:offsets[neuron_id + 1]]
+
+
+def to_spike_times(times, offsets):
+    '''
+    Convert CSR spike trains to the per-neuron list expected by the
+    spike_times parameter of a SpikeSourceArray. The entries are views into
+    times, no spikes are copied.
+    '''
+    return np.split(times, offsets[1:-1])
+
+
+def to_spike_array(times, offsets):
+    '''
+    Convert CSR spike trains to the (neuron id, time) layout returned by
+    getSpikes(compatible_output=True).
+    '''
+    neuron_ids = np.repeat(np.arange(offsets.size - 1), np.diff(offsets))
+    return np.column_stack((neuron_ids, times))
+
+
+def _schedule_rows(rates, start, stop):
+    if hasattr(rates, 'rates'):
+        # A RateSchedule, only this chunk gets expanded to float rates
+        return rates.rates(start, stop)
+    return np.asarray(rates[start:stop], dtype=float)
+
+
+def variable_rate_poisson(rates, t_stim, t_start=0., chunk_frames=1500,
+                          rng=None):
+    '''
+    Stream the spikes of an inhomogeneous Poisson population driven by a
+    (frames, N) rate schedule, where each row is held for t_stim ms starting
+    at t_start, as with a SpikeSourcePoissonVariable using
+    rate_interval_duration = t_stim. rates may also be a RateSchedule.
+
+    Spikes are generated by thinning, chunk_frames frames at a time: candidate
+    spikes are drawn at each neuron's peak rate over the chunk and kept with
+    probability rate / peak rate of the frame they fall in. A spike in
+    [t, t + 1) is reported at t, so nothing is lost at chunk boundaries.
+
+    Yields (times, offsets) in CSR layout for each chunk in turn.
+    '''
+    rng = _rng(rng)
+    no_frames, N = rates.shape
+    for start in range(0, no_frames, chunk_frames):
+        stop = min(start + chunk_frames, no_frames)
+        chunk = np.maximum(_schedule_rows(rates, start, stop), 0.)
+        chunk_start = t_start + start * t_stim
+        chunk_stop = t_start + stop * t_stim
+        duration = float(chunk_stop - chunk_start)
+
+        peak_rates = np.max(chunk, axis=0)
+        counts = rng.poisson(peak_rates * duration / 1000.)
+        neuron_ids = np.repeat(np.arange(N), counts)
+        offsets_in_chunk = rng.uniform(0., duration, size=neuron_ids.size)
+        frames = np.minimum((offsets_in_chunk // t_stim).astype(np.int64),
+                            stop - start - 1)
+        accept = rng.uniform(size=neuron_ids.size) * \
+                 peak_rates[neuron_ids] < chunk[frames, neuron_ids]
+        yield _compress(neuron_ids[accept],
+                        np.floor(chunk_start + offsets_in_chunk[accept]),
+                        N, chunk_stop)
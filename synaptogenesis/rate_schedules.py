@@ -0,0 +1,291 @@
+import os
+import shutil
+from collections import OrderedDict
+from tempfile import mkdtemp
+
+import numpy as np
+
+from geometry import grid_coordinates, squared_distance_table, torus_delta
+
+# +-------------------------------------------------------------------+
+# | Stimulus schedules for SpikeSourcePoissonVariable                 |
+# +-------------------------------------------------------------------+
+
+# Input shapes, mirroring the single frame generators in
+# function_definitions
+GAUSSIAN_RATES = 'gaussian'  # generate_gaussian_input_rates
+POINTY_RATES = 'pointy'  # generate_rates
+SCALED_POINTY_RATES = 'scaled_pointy'  # generate_scaled_pointy_rates
+SQUARE_RATES = 'square'  # generate_square_rates
+
+RATE_KINDS = (GAUSSIAN_RATES, POINTY_RATES, SCALED_POINTY_RATES,
+              SQUARE_RATES)
+
+
+def _squared_distances(centres, grid):
+    '''
+    (frames, N) squared torus distances between every stimulus centre and
+    every cell of the grid.
+    '''
+    grid = np.asarray(grid)
+    if np.issubdtype(centres.dtype, np.integer):
+        centre_ids = np.mod(centres[:, 0], grid[0]) * grid[1] + \
+                     np.mod(centres[:, 1], grid[1])
+        return squared_distance_table(grid)[centre_ids]
+    delta = torus_delta(centres[:, None, :],
+                        grid_coordinates(grid)[None, :, :], grid)
+    return (delta ** 2).sum(axis=-1)
+
+
+def _scale_to_mean(rates, f_base, f_mean):
+    means_ratio = float(f_mean - f_base) / np.mean(rates, axis=1)
+    return rates * means_ratio[:, None] + f_base
+
+
+def _check_kind(kind):
+    if kind not in RATE_KINDS:
+        raise ValueError("Unknown input kind {}. Expected one of {}".format(
+            kind, RATE_KINDS))
+
+
+def _direct_rate_schedule(centres, kind, grid, f_base, f_peak, sigma_stim,
+                          f_mean):
+    _d2 = _squared_distances(centres, grid)
+
+    if kind == GAUSSIAN_RATES:
+        rates = f_peak * np.exp(-_d2 / (sigma_stim ** 2 * 2))
+        rates = _scale_to_mean(rates, f_base, f_mean)
+    elif kind == POINTY_RATES:
+        rates = f_base + f_peak * np.exp((-np.sqrt(_d2) * 2) /
+                                         (sigma_stim ** 2))
+    elif kind == SCALED_POINTY_RATES:
+        rates = f_peak * np.exp((-np.sqrt(_d2) * 2) / (sigma_stim ** 2))
+        rates = _scale_to_mean(rates, f_base, f_mean)
+    else:
+        rates = (np.sqrt(_d2) <= float(sigma_stim)).astype(float)
+        rates *= (f_mean - f_base) * rates.shape[1] / \
+                 np.count_nonzero(rates, axis=1)[:, None].astype(float)
+        rates += f_base
+
+    if kind != POINTY_RATES:
+        assert np.allclose(np.mean(rates, axis=1), f_mean, 0.01, 0.01), \
+            "{} vs. {}".format(np.mean(rates, axis=1), f_mean)
+    return rates
+
+
+class RateTemplateCache(object):
+    '''
+    On a periodic grid every stimulus of a given kind is a circular shift of
+    the same stimulus centred at the origin. This cache builds that centred
+    template once per (kind, grid, sigma_stim, f_base, f_peak, f_mean) and
+    evicts the least recently used template once maxsize is exceeded, so
+    parameter sweeps do not grow memory without bound.
+    '''
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._templates = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._templates)
+
+    def clear(self):
+        self._templates.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def template(self, kind, grid=np.asarray([16, 16]), f_base=5.,
+                 f_peak=152.8, sigma_stim=2., f_mean=20.):
+        '''
+        Read-only rates, shaped like the grid, of the stimulus centred at
+        (0, 0).
+        '''
+        _check_kind(kind)
+        grid = np.asarray(grid)
+        key = (kind, tuple(int(g) for g in grid.ravel()), float(sigma_stim),
+               float(f_base), float(f_peak), float(f_mean))
+        if key in self._templates:
+            self.hits += 1
+            # Re-insert to mark as most recently used
+            template = self._templates.pop(key)
+        else:
+            self.misses += 1
+            template = _direct_rate_schedule(
+                np.zeros((1, 2), dtype=int), kind, grid, f_base, f_peak,
+                sigma_stim, f_mean).reshape(grid)
+            template.setflags(write=False)
+            while len(self._templates) >= max(self.maxsize, 1):
+                self._templates.popitem(last=False)
+        self._templates[key] = template
+        return template
+
+
+rate_templates = RateTemplateCache()
+
+
+def centred_rates(centre, kind, grid=np.asarray([16, 16]), f_base=5.,
+                  f_peak=152.8, sigma_stim=2., f_mean=20.):
+    '''
+    Rates, shaped like the grid, of a single stimulus centred at centre,
+    served as a circular shift of the cached template.
+    '''
+    template = rate_templates.template(kind, grid, f_base=f_base,
+                                       f_peak=f_peak, sigma_stim=sigma_stim,
+                                       f_mean=f_mean)
+    centre = np.asarray(centre).ravel()
+    return np.roll(np.roll(template, int(centre[0]), axis=0),
+                   int(centre[1]), axis=1)
+
+
+def generate_rate_schedule(centres, kind, grid=np.asarray([16, 16]),
+                           f_base=5., f_peak=152.8, sigma_stim=2.,
+                           f_mean=20.):
+    '''
+    Function that generates the rates for a whole stimulus schedule at once.
+    Row i of the (frames, N_layer) result holds the rates of the frame centred
+    at centres[i], identical to what the single frame generator for that kind
+    of input would produce, including its mean rate normalisation.
+
+    Integer centres are served by gathering from the cached template, so no
+    exponentials are evaluated per frame.
+    '''
+    _check_kind(kind)
+    grid = np.asarray(grid)
+    centres = np.asarray(centres).reshape(-1, 2)
+    if not np.issubdtype(centres.dtype, np.integer):
+        return _direct_rate_schedule(centres, kind, grid, f_base, f_peak,
+                                     sigma_stim, f_mean)
+
+    template = rate_templates.template(kind, grid, f_base=f_base,
+                                       f_peak=f_peak, sigma_stim=sigma_stim,
+                                       f_mean=f_mean)
+    # Cell (x, y) of the frame centred at (cx, cy) has the template value at
+    # (x - cx, y - cy), wrapped around the grid
+    rows = np.mod(np.arange(grid[0])[None, :] - centres[:, 0:1], grid[0])
+    columns = np.mod(np.arange(grid[1])[None, :] - centres[:, 1:2], grid[1])
+    rates = template[rows[:, :, None], columns[:, None, :]]
+    return rates.reshape(centres.shape[0], grid[0] * grid[1])
+
+
+class RateSchedule(object):
+    '''
+    Compact storage for a (frames, N_layer) stimulus schedule. Rates are kept
+    either as float32 or quantised to uint8 / uint16 between offset and
+    offset + scale * max_int, optionally in a disk-backed np.memmap, and are
+    only converted back to float rates when requested, e.g. when handed to a
+    SpikeSourcePoissonVariable.
+    '''
+
+    def __init__(self, no_frames, N_layer, t_stim, dtype=np.uint16, scale=1.,
+                 offset=0., filename=None, in_memory=False):
+        self.t_stim = t_stim
+        self.dtype = np.dtype(dtype)
+        self.scale = float(scale)
+        self.offset = float(offset)
+        self._tmp_dir = None
+        shape = (int(no_frames), int(N_layer))
+        if in_memory:
+            self._data = np.zeros(shape, dtype=self.dtype)
+        else:
+            if filename is None:
+                self._tmp_dir = mkdtemp()
+                filename = os.path.join(self._tmp_dir, 'rates.dat')
+            self._data = np.memmap(filename, dtype=self.dtype, mode='w+',
+                                   shape=shape)
+        self.filename = filename
+
+    @classmethod
+    def from_centres(cls, centres, kind, t_stim, grid=np.asarray([16, 16]),
+                     f_base=5., f_peak=152.8, sigma_stim=2., f_mean=20.,
+                     dtype=np.uint16, filename=None, in_memory=False,
+                     chunk_frames=10000):
+        '''
+        Build the schedule for the given stimulus centres chunk by chunk, so
+        that at most chunk_frames float rows exist at any one time.
+        '''
+        grid = np.asarray(grid)
+        centres = np.asarray(centres).reshape(-1, 2)
+        template = rate_templates.template(kind, grid, f_base=f_base,
+                                           f_peak=f_peak,
+                                           sigma_stim=sigma_stim,
+                                           f_mean=f_mean)
+        dtype = np.dtype(dtype)
+        scale, offset = 1., 0.
+        if np.issubdtype(dtype, np.integer):
+            offset = np.min(template)
+            if np.max(template) > offset:
+                scale = (np.max(template) - offset) / float(
+                    np.iinfo(dtype).max)
+        schedule = cls(centres.shape[0], grid[0] * grid[1], t_stim,
+                       dtype=dtype, scale=scale, offset=offset,
+                       filename=filename, in_memory=in_memory)
+        for start in range(0, centres.shape[0], chunk_frames):
+            schedule.fill(start, generate_rate_schedule(
+                centres[start:start + chunk_frames], kind, grid=grid,
+                f_base=f_base, f_peak=f_peak, sigma_stim=sigma_stim,
+                f_mean=f_mean))
+        return schedule
+
+    @property
+    def shape(self):
+        return self._data.shape
+
+    @property
+    def nbytes(self):
+        return self._data.nbytes
+
+    def __len__(self):
+        return self._data.shape[0]
+
+    def fill(self, start, rates):
+        '''
+        Store float rates for the frames starting at start.
+        '''
+        rates = np.asarray(rates)
+        stop = start + rates.shape[0]
+        if np.issubdtype(self.dtype, np.integer):
+            info = np.iinfo(self.dtype)
+            self._data[start:stop] = np.clip(
+                np.round((rates - self.offset) / self.scale),
+                info.min, info.max)
+        else:
+            self._data[start:stop] = rates
+        return stop
+
+    def rates(self, start=0, stop=None, dtype=float):
+        '''
+        Float rates for frames [start, stop).
+        '''
+        stored = self._data[start:stop]
+        if np.issubdtype(self.dtype, np.integer):
+            rates = stored.astype(dtype)
+            rates *= self.scale
+            rates += self.offset
+            return rates
+        return np.array(stored, dtype=dtype)
+
+    def __array__(self, dtype=None):
+        return self.rates(dtype=dtype or float)
+
+    def close(self):
+        '''
+        Release the storage and remove the backing file if it was temporary.
+        '''
+        if isinstance(self._data, np.memmap):
+            self._data.flush()
+        self._data = None
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, '_tmp_dir', None) is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
@@ -0,0 +1,255 @@
+import glob
+import json
+import os
+
+import numpy as np
+
+from connectivity import CONNECTION_DTYPE, ConnectionList, \
+    as_connection_records
+from fileutils import atomic_write, makedirs
+
+# +-------------------------------------------------------------------+
+# | Synaptic snapshots                                                |
+# +-------------------------------------------------------------------+
+
+# Fields read from a projection for every snapshot, in CONNECTION_DTYPE order
+SNAPSHOT_FIELDS = ('source', 'target', 'weight', 'delay')
+
+
+def read_synaptic_data(projection, out=None):
+    '''
+    All synapses of a projection as CONNECTION_DTYPE records, read from the
+    machine in a single request rather than once per field. With out, a
+    ConnectionList, the records are appended to it and the appended view is
+    returned.
+    '''
+    records = as_connection_records(
+        projection._get_synaptic_data(True, list(SNAPSHOT_FIELDS)))
+    if out is None:
+        return records
+    start = len(out)
+    out.extend(records)
+    return out.array[start:]
+
+
+class SnapshotBuffer(object):
+    '''
+    Preallocated buffer holding one snapshot of several projections as
+    contiguous CONNECTION_DTYPE records. The buffer only grows, so taking a
+    snapshot every t_record ms reuses the same memory instead of allocating
+    float64 copies of every field.
+    '''
+
+    def __init__(self, capacity=0):
+        self._connections = ConnectionList(capacity=capacity)
+        self._offsets = [0]
+
+    def extract(self, projections):
+        '''
+        Read every projection into the buffer, replacing the previous
+        snapshot. Returns one view per projection, valid until the next call.
+        '''
+        self._connections.clear()
+        self._offsets = [0]
+        for projection in projections:
+            read_synaptic_data(projection, out=self._connections)
+            self._offsets.append(len(self._connections))
+        return self.views()
+
+    @property
+    def records(self):
+        return self._connections.array
+
+    @property
+    def offsets(self):
+        return np.asarray(self._offsets, dtype=np.int64)
+
+    def views(self):
+        records = self.records
+        return [records[start:stop]
+                for start, stop in zip(self._offsets[:-1], self._offsets[1:])]
+
+    def copies(self):
+        '''
+        Independent compact copies of the views, for keeping the snapshot.
+        '''
+        return [np.array(view, dtype=CONNECTION_DTYPE)
+                for view in self.views()]
+
+
+# +-------------------------------------------------------------------+
+# | On-disk snapshot store                                            |
+# +-------------------------------------------------------------------+
+
+# Every snapshot is written, as soon as it is taken, to its own .npy chunk
+# holding the records of all projections back to back. A JSON index lists the
+# chunks in order with their simulation time and per-projection offsets. Both
+# are replaced atomically, so a crashed run keeps every snapshot taken before
+# the crash.
+#
+# A store is opened read-only ('r'), created ('w') or resumed ('a'). Creating
+# one in a directory that already holds a store fails unless overwrite is set,
+# so a second run never silently extends the series of the first.
+
+SNAPSHOT_INDEX = 'index.json'
+SNAPSHOT_STORE_VERSION = 1
+
+
+def _write_records(f, arrays):
+    # One .npy file from several record arrays without concatenating them
+    total = sum(len(array) for array in arrays)
+    np.lib.format.write_array_header_1_0(
+        f, {'descr': np.lib.format.dtype_to_descr(np.dtype(CONNECTION_DTYPE)),
+            'fortran_order': False,
+            'shape': (total,)})
+    for array in arrays:
+        f.write(np.ascontiguousarray(array).tobytes())
+
+
+class SnapshotStore(object):
+    '''
+    Append-only directory of weight snapshots. With keep_recent, snapshots
+    older than the keep_recent most recent ones are thinned to every
+    thin_stride-th snapshot taken; the first snapshot is always kept.
+    '''
+
+    def __init__(self, directory, names=None, keep_recent=None,
+                 thin_stride=10, mode='r', overwrite=False):
+        if mode not in ('r', 'w', 'a'):
+            raise ValueError("Unknown snapshot store mode {}".format(mode))
+        self.directory = os.path.abspath(directory)
+        self.mode = mode
+        self.keep_recent = keep_recent
+        self.thin_stride = thin_stride
+        index_filename = os.path.join(self.directory, SNAPSHOT_INDEX)
+        if mode == 'w':
+            if overwrite:
+                self._remove_store()
+            elif os.path.isdir(self.directory) and \
+                    os.listdir(self.directory):
+                raise ValueError(
+                    "{} is not empty; pass overwrite to replace the "
+                    "snapshots in it".format(self.directory))
+        if mode == 'r' or (mode == 'a' and os.path.exists(index_filename)):
+            self._index = self._load_index(index_filename)
+        else:
+            makedirs(self.directory)
+            self._index = {'version': SNAPSHOT_STORE_VERSION,
+                           'names': None,
+                           'taken': 0,
+                           'snapshots': []}
+        if names is not None:
+            names = list(names)
+            if self._index['names'] not in (None, names):
+                raise ValueError(
+                    "Snapshot store {} holds projections {}, not {}".format(
+                        self.directory, self._index['names'], names))
+            self._index['names'] = names
+
+    @staticmethod
+    def _load_index(index_filename):
+        with open(index_filename, 'r') as f:
+            try:
+                return json.load(f)
+            except ValueError as e:
+                raise ValueError("Cannot read snapshot index {}: {}".format(
+                    index_filename, e))
+
+    def _remove_store(self):
+        for filename in glob.glob(os.path.join(self.directory,
+                                               'snapshot_*.npy')) + \
+                [os.path.join(self.directory, SNAPSHOT_INDEX)]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    @property
+    def names(self):
+        return self._index['names']
+
+    @property
+    def times(self):
+        return np.array([entry['time'] for entry in self._index['snapshots']])
+
+    def __len__(self):
+        return len(self._index['snapshots'])
+
+    def append(self, time, arrays):
+        '''
+        Write one snapshot, a sequence of record arrays in projection order,
+        taken at time ms, later than any snapshot already in the store.
+        '''
+        if self.mode == 'r':
+            raise ValueError(
+                "Snapshot store {} is open read-only".format(self.directory))
+        snapshots = self._index['snapshots']
+        if snapshots and time <= snapshots[-1]['time']:
+            raise ValueError(
+                "Snapshot at {} ms is not after the last one in {}, at {} "
+                "ms".format(time, self.directory, snapshots[-1]['time']))
+        arrays = [as_connection_records(array) for array in arrays]
+        if self.names is not None and len(arrays) != len(self.names):
+            raise ValueError(
+                "Expected {} projections, got {}".format(len(self.names),
+                                                         len(arrays)))
+        taken = self._index['taken']
+        chunk = "snapshot_{:07d}.npy".format(taken)
+        atomic_write(os.path.join(self.directory, chunk),
+                     lambda f: _write_records(f, arrays))
+        self._index['snapshots'].append({
+            'taken': taken,
+            'time': time,
+            'file': chunk,
+            'offsets': np.cumsum(
+                [0] + [len(array) for array in arrays]).tolist()})
+        self._index['taken'] = taken + 1
+        thinned = self._thin()
+        self._save_index()
+        for entry in thinned:
+            try:
+                os.remove(os.path.join(self.directory, entry['file']))
+            except OSError:
+                pass
+
+    def _thin(self):
+        if self.keep_recent is None:
+            return []
+        snapshots = self._index['snapshots']
+        old = len(snapshots) - self.keep_recent
+        if old <= 0:
+            return []
+        kept, thinned = [], []
+        for entry in snapshots[:old]:
+            if entry['taken'] % self.thin_stride == 0:
+                kept.append(entry)
+            else:
+                thinned.append(entry)
+        self._index['snapshots'] = kept + snapshots[old:]
+        return thinned
+
+    def _save_index(self):
+        atomic_write(os.path.join(self.directory, SNAPSHOT_INDEX),
+                     lambda f: f.write(json.dumps(self._index, indent=1)))
+
+    def snapshot(self, index):
+        '''
+        The records of every projection in one snapshot, as views of a
+        read-only memmap of its chunk.
+        '''
+        entry = self._index['snapshots'][index]
+        records = np.load(os.path.join(self.directory, entry['file']),
+                          mmap_mode='r')
+        offsets = entry['offsets']
+        return [records[start:stop]
+                for start, stop in zip(offsets[:-1], offsets[1:])]
+
+    def projection(self, index, name):
+        return self.snapshot(index)[self.names.index(name)]
+
+    def __getitem__(self, index):
+        return self.snapshot(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.snapshot(index)
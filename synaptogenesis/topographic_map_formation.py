@@ -13,6 +13,7 @@ import time
 import spynnaker7.pyNN as sim
 
 from function_definitions import *
+from rate_schedules import *
 from argparser import *
 
 case = args.case
@@ -91,6 +92,9 @@ tau_plus = 20.  # ms
 tau_minus = args.t_minus  # ms
 a_minus = (a_plus * tau_plus * b) / tau_minus
 
+# Connectivity generation
+seed = args.seed if args.seed is not None else new_seed()
+
 # Reporting
 
 sim_params = {'g_max': g_max,
@@ -121,21 +125,26 @@ sim_params = {'g_max': g_max,
               'a_plus': a_plus,
               'input_type': args.input_type,
               'random_partner': args.random_partner,
-              'lesion': args.lesion
+              'lesion': args.lesion,
+              'seed': seed
               }
 
 if args.input_type == GAUSSIAN_INPUT:
     print("Gaussian input")
     gen_rate = generate_gaussian_input_rates
+    rate_kind = GAUSSIAN_RATES
 elif args.input_type == POINTY_INPUT:
     print("Pointy input")
     gen_rate = generate_rates
+    rate_kind = POINTY_RATES
 elif args.input_type == SCALED_POINTY_INPUT:
     print("Scaled pointy input")
     gen_rate = generate_scaled_pointy_rates
+    rate_kind = SCALED_POINTY_RATES
 elif args.input_type == SQUARE_INPUT:
     print("Square input")
     gen_rate = generate_square_rates
+    rate_kind = SQUARE_RATES
 
 # +-------------------------------------------------------------------+
 # | Initial network setup                                             |
@@ -152,21 +161,19 @@ if case == CASE_REW_NO_CORR:
                                  }, label="Poisson spike source")
 elif case == CASE_CORR_AND_REW or case == CASE_CORR_NO_REW:
 
-    rates = np.empty((simtime // t_stim, grid[0], grid[1]))
-    for rate_id in range(simtime // t_stim):
-        r = gen_rate(np.random.randint(0, n, size=2),
-                     f_base=f_base,
-                     grid=grid,
-                     f_peak=args.f_peak,
-                     sigma_stim=sigma_stim)
-        # assert np.isclose(np.average(r), f_mean, 0.1, 0.1), np.average(r)
-
-        rates[rate_id, :, :] = r
-    rates = rates.reshape(simtime // t_stim, N_layer)
+    stimulus_centres = np.random.randint(0, n, size=(simtime // t_stim, 2))
+    # Rates are stored quantised and only expanded, to float32, when handed
+    # to the source
+    rate_schedule = RateSchedule.from_centres(stimulus_centres, rate_kind,
+                                              t_stim,
+                                              f_base=f_base,
+                                              grid=grid,
+                                              f_peak=args.f_peak,
+                                              sigma_stim=sigma_stim)
 
     source_pop = sim.Population(N_layer,
                                 sim.SpikeSourcePoissonVariable,
-                                {'rate': rates,
+                                {'rate': rate_schedule.rates(dtype=np.float32),
                                  'start': 100,
                                  'duration': simtime,
                                  'rate_interval_duration': t_stim
@@ -175,20 +182,22 @@ elif case == CASE_CORR_AND_REW or case == CASE_CORR_NO_REW:
 ff_s = np.zeros(N_layer, dtype=np.uint)
 lat_s = np.zeros(N_layer, dtype=np.uint)
 
-init_ff_connections = []
-init_lat_connections = []
+init_ff_connections = ConnectionList()
+init_lat_connections = ConnectionList()
 
 if args.initial_connectivity_file is None:
     generate_initial_connectivity(
         ff_s, init_ff_connections,
         sigma_form_forward, p_form_forward,
         "\nGenerating initial feedforward connectivity...",
-        N_layer=N_layer, n=n, s_max=s_max, g_max=g_max, delay=args.delay)
+        N_layer=N_layer, n=n, s_max=s_max, g_max=g_max, delay=args.delay,
+        seed=seed, stream=FF_STREAM, processes=args.processes)
     generate_initial_connectivity(
         lat_s, init_lat_connections,
         sigma_form_lateral, p_form_lateral,
         "\nGenerating initial lateral connectivity...",
-        N_layer=N_layer, n=n, s_max=s_max, g_max=g_max, delay=args.delay)
+        N_layer=N_layer, n=n, s_max=s_max, g_max=g_max, delay=args.delay,
+        seed=seed, stream=LAT_STREAM, processes=args.processes)
     print("\n")
 else:
     if "npz" in args.initial_connectivity_file:
@@ -200,17 +209,8 @@ else:
     conn = initial_connectivity['ConnPostToPre'] - 1
     weight = initial_connectivity['WeightPostToPre']
 
-    for target in range(conn.shape[1]):
-        for index in range(conn.shape[0]):
-            if conn[index, target] >= 0:
-                if conn[index, target] < N_layer:
-                    init_ff_connections.append(
-                        (conn[index, target], target,
-                         weight[index, target], 1))
-                else:
-                    init_lat_connections.append(
-                        (conn[index, target] - N_layer, target,
-                         weight[index, target], 1))
+    init_ff_connections, init_lat_connections = post_pre_to_connections(
+        conn, weight, N_layer)
 
 # Neuron populations
 target_pop = sim.Population(N_layer, model, cell_params, label="TARGET_POP")
@@ -280,7 +280,7 @@ elif args.lesion == ONE_TO_ONE_LESION:
     # init_ff_connections = ff_prob_conn
     # init_lat_connections = lat_prob_conn
 
-    one_to_one_conn = [(i, i, g_max, args.delay) for i in range(N_layer)]
+    one_to_one_conn = one_to_one_connections(N_layer, g_max, args.delay)
     ff_projection = sim.Projection(
         source_pop, target_pop,
         sim.FromListConnector(one_to_one_conn),
@@ -319,10 +319,12 @@ elif args.lesion == RANDOM_CONNECTIVITY_LESION:
     # init_lat_connections = np.asarray(init_lat_connections)
     print("Insulted network")
 
-    ff_prob_conn = [(i, j, g_max, args.delay) for i in range(N_layer) for j in
-                    range(N_layer) if np.random.rand() < .05]
-    lat_prob_conn = [(i, j, g_max, args.delay) for i in range(N_layer) for j in
-                     range(N_layer) if np.random.rand() < .05]
+    ff_prob_conn = fixed_probability_connections(
+        N_layer, N_layer, .05, g_max, args.delay,
+        rng=block_rng(seed, FF_STREAM, 0))
+    lat_prob_conn = fixed_probability_connections(
+        N_layer, N_layer, .05, g_max, args.delay,
+        rng=block_rng(seed, LAT_STREAM, 0))
 
     init_ff_connections = ff_prob_conn
     init_lat_connections = lat_prob_conn
@@ -388,6 +390,15 @@ post_delays = []
 e = None
 print("Starting the sim")
 
+snapshot_store = None
+if args.snapshot_dir:
+    snapshot_store = SnapshotStore(args.snapshot_dir, names=('ff', 'lat'),
+                                   keep_recent=args.snapshot_keep_recent,
+                                   thin_stride=args.snapshot_thin_stride,
+                                   mode='w',
+                                   overwrite=args.snapshot_overwrite)
+snapshot_buffer = SnapshotBuffer()
+
 no_runs = simtime // t_record
 run_duration = t_record
 
@@ -413,18 +424,18 @@ try:
         #     source_pop.set("rate", rates.ravel())
 
         if (current_run + 1) * run_duration % t_record == 0:
-            pre_weights.append(
-                np.array([
-                    ff_projection._get_synaptic_data(True, 'source'),
-                    ff_projection._get_synaptic_data(True, 'target'),
-                    ff_projection._get_synaptic_data(True, 'weight'),
-                    ff_projection._get_synaptic_data(True, 'delay')]).T)
-            post_weights.append(
-                np.array([
-                    lat_projection._get_synaptic_data(True, 'source'),
-                    lat_projection._get_synaptic_data(True, 'target'),
-                    lat_projection._get_synaptic_data(True, 'weight'),
-                    lat_projection._get_synaptic_data(True, 'delay')]).T)
+            snapshot = snapshot_buffer.extract([ff_projection,
+                                                lat_projection])
+            if snapshot_store is not None:
+                snapshot_store.append((current_run + 1) * run_duration,
+                                      snapshot)
+                # Only the latest snapshot stays in memory, as views of the
+                # buffer
+                del pre_weights[:], post_weights[:]
+            else:
+                snapshot = snapshot_buffer.copies()
+            pre_weights.append(snapshot[0])
+            post_weights.append(snapshot[1])
     if args.record_source:
         pre_spikes = source_pop.getSpikes(compatible_output=True)
     else:
@@ -462,6 +473,8 @@ np.savez(filename, pre_spikes=pre_spikes,
          lat_connections=post_weights,
          final_pre_weights=pre_weights[-1],
          final_post_weights=post_weights[-1],
+         snapshot_dir=(snapshot_store.directory
+                       if snapshot_store is not None else None),
          simtime=simtime,
          sim_params=sim_params,
          total_time=total_time,